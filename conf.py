@@ -1,13 +1,22 @@
 import os
 
+import corneferencer.resources as resources
 import corneferencer.utils as utils
-
-from gensim.models.word2vec import Word2Vec
+from corneferencer.resources import ResourceManager
 
 
 CONTEXT = 5
 RANDOM_WORD_VECTORS = True
+# vectors of out of vocabulary words: hash (stable, derived from the lemma) or random (different in every lookup)
+OOV_VECTORS = 'hash'
 CLEAR_INPUT = False
+# keep lxml elements of mentions (Mention.node), which keeps whole mentions layer trees in memory;
+# writers do not need them
+KEEP_MENTION_NODES = False
+# output layers which are not changed are hardlinked (or symlinked) to input layers instead of copied
+LINK_LAYERS = False
+# compression level of written gzipped layers (1-9)
+GZIP_LEVEL = 9
 W2V_SIZE = 50
 W2V_MODEL_NAME = 'w2v_allwiki_nkjpfull_50.model'
 
@@ -15,6 +24,25 @@ W2V_MODEL_NAME = 'w2v_allwiki_nkjpfull_50.model'
 NEURAL_MODEL_ARCHITECTURE = 'simple'
 NUMBER_OF_FEATURES = 1190
 NEURAL_MODEL_NAME = '' # 'model_1147_features.h5'
+# keras or numpy (numpy does not need tensorflow)
+NEURAL_MODEL_BACKEND = 'keras'
+
+# number of mention pairs scored by one neural model call
+BATCH_SIZE = 4096
+# precompute first layer projections per mention instead of per mention pair (simple architecture only)
+FACTORIZED_INFERENCE = False
+# candidate antecedents window: maximal distance in mentions, sentences and paragraphs (0 means no limit),
+# antecedents with the same text or the same head are candidates regardless of the distance if KEEP_MATCHING_CANDIDATES
+MAX_MENTION_DISTANCE = 0
+MAX_SENTENCE_DISTANCE = 0
+MAX_PARAGRAPH_DISTANCE = 0
+KEEP_MATCHING_CANDIDATES = True
+# directory of cached mention pairs scores (one npz file per text), empty means no cache
+SCORES_CACHE_PATH = ''
+
+# worker processes used for input directories, workers are replaced after given number of texts
+WORKERS = 1
+MAX_TASKS_PER_CHILD = 50
 
 FREQ_LIST_NAME = 'base.lst'
 LEMMA2SYNONYMS_NAME = 'lemma2synonyms.map'
@@ -27,22 +55,41 @@ TITLE2REDIRECT_NAME = 'redirect.map'
 MAIN_PATH = os.path.dirname(__file__)
 
 W2V_MODEL_PATH = os.path.join(MAIN_PATH, 'models', W2V_MODEL_NAME)
-print(W2V_MODEL_PATH)
-W2V_MODEL = Word2Vec.load(W2V_MODEL_PATH)
 
 NEURAL_MODEL_PATH = os.path.join(MAIN_PATH, 'models', NEURAL_MODEL_NAME)
 
 FREQ_LIST_PATH = os.path.join(MAIN_PATH, 'freq', FREQ_LIST_NAME)
-FREQ_LIST = utils.load_freq_list(FREQ_LIST_PATH)
 
 LEMMA2SYNONYMS_PATH = os.path.join(MAIN_PATH, 'wordnet', LEMMA2SYNONYMS_NAME)
-LEMMA2SYNONYMS = utils.load_one2many_map(LEMMA2SYNONYMS_PATH)
 
 LEMMA2HYPERNYMS_PATH = os.path.join(MAIN_PATH, 'wordnet', LEMMA2HYPERNYMS_NAME)
-LEMMA2HYPERNYMS = utils.load_one2many_map(LEMMA2HYPERNYMS_PATH)
 
 TITLE2LINKS_PATH = os.path.join(MAIN_PATH, 'wikipedia', TITLE2LINKS_NAME)
-TITLE2LINKS = utils.load_one2many_map(TITLE2LINKS_PATH)
 
 TITLE2REDIRECT_PATH = os.path.join(MAIN_PATH, 'wikipedia', TITLE2REDIRECT_NAME)
-TITLE2REDIRECT = utils.load_one2one_map(TITLE2REDIRECT_PATH)
+
+
+# resources are loaded on first access (e.g. conf.W2V_MODEL), use preload() in worker processes
+RESOURCES = ResourceManager()
+RESOURCES.register('W2V_MODEL', lambda: resources.load_embeddings(W2V_MODEL_PATH))
+RESOURCES.register('FREQ_LIST', lambda: utils.load_freq_list(FREQ_LIST_PATH))
+# java serialized maps are replaced by their bundles created with convert_resources.py when present
+RESOURCES.register('LEMMA2SYNONYMS', lambda: resources.load_map(LEMMA2SYNONYMS_PATH))
+RESOURCES.register('LEMMA2HYPERNYMS', lambda: resources.load_map(LEMMA2HYPERNYMS_PATH))
+RESOURCES.register('TITLE2LINKS', lambda: resources.load_map(TITLE2LINKS_PATH))
+RESOURCES.register('TITLE2REDIRECT', lambda: resources.load_map(TITLE2REDIRECT_PATH, one2many=False))
+
+
+def __getattr__(name):
+    if RESOURCES.is_registered(name):
+        resource = RESOURCES.get(name)
+        # later lookups find the resource directly in module globals
+        globals()[name] = resource
+        return resource
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def preload(names=None):
+    RESOURCES.preload(names)
+    for name in RESOURCES.resources:
+        globals()[name] = RESOURCES.resources[name]
@@ -0,0 +1,46 @@
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+
+from importlib.machinery import EXTENSION_SUFFIXES
+
+from Cython.Build import cythonize
+from setuptools import Extension, setup
+
+
+MAIN_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+EXTENSIONS = [('corneferencer.resolvers.accelerated', 'corneferencer/resolvers/accelerated.pyx')]
+CHECK_SCRIPT = os.path.join(MAIN_PATH, 'corneferencer', 'check_accelerators.py')
+
+
+# builds compiled versions of feature functions in place, next to their sources, and checks them against
+# pure python versions; corneferencer uses pure python versions when they are not built or the check fails
+def main():
+    os.chdir(MAIN_PATH)
+    extensions = [Extension(name, [source]) for name, source in EXTENSIONS]
+    with tempfile.TemporaryDirectory() as build_dir:
+        setup(name='corneferencer-accelerators',
+              ext_modules=cythonize(extensions),
+              script_args=['build_ext', '--inplace',
+                           '--build-temp', os.path.join(build_dir, 'temp'),
+                           '--build-lib', os.path.join(build_dir, 'lib')])
+
+    # checked in a new process, so that freshly built modules are imported
+    if subprocess.call([sys.executable, CHECK_SCRIPT]) != 0:
+        remove_built_modules()
+        sys.exit(1)
+
+
+def remove_built_modules():
+    for _, source in EXTENSIONS:
+        module_path = os.path.splitext(source)[0]
+        for suffix in EXTENSION_SUFFIXES:
+            for built_path in glob.glob(module_path + suffix):
+                print('removing %s' % built_path)
+                os.remove(built_path)
+
+
+if __name__ == '__main__':
+    main()
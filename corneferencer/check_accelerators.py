@@ -0,0 +1,98 @@
+import os
+import random
+import sys
+import timeit
+
+from argparse import ArgumentParser
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+from corneferencer.resolvers import features
+from corneferencer.utils import eprint
+
+
+# letters of generated strings, few of them so that strings share subsequences
+ALPHABET = u'aąbcćeęlłnńoóśzźż -'
+
+
+def main():
+    args = parse_arguments()
+    if features.accelerated is None:
+        eprint("Error: Accelerator module is not built, run corneferencer/build_accelerators.py!")
+        sys.exit(1)
+    check_accelerators(args.pairs, args.max_length, args.seed)
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Corneferencer: checks compiled feature functions against '
+                                        'pure python versions on generated strings and measures their speed.')
+    parser.add_argument('-p', '--pairs', type=int, action='store',
+                        dest='pairs', default=2000,
+                        help='number of generated string pairs; default: 2000')
+    parser.add_argument('-l', '--max-length', type=int, action='store',
+                        dest='max_length', default=40,
+                        help='maximal length of generated strings; default: 40')
+    parser.add_argument('-s', '--seed', type=int, action='store',
+                        dest='seed', default=0,
+                        help='random seed of generated strings; default: 0')
+    args = parser.parse_args()
+    return args
+
+
+def check_accelerators(pairs_count, max_length, seed):
+    arguments = generate_pairs(pairs_count, max_length, random.Random(seed))
+    print('%d string pairs' % len(arguments))
+
+    all_equal = True
+    for name in features.ACCELERATED_FUNCTIONS:
+        python_function = features.PYTHON_FUNCTIONS[name]
+        compiled_function = getattr(features.accelerated, name)
+
+        mismatches = sum(1 for args in arguments if not same_results(python_function(*args), compiled_function(*args)))
+        all_equal = all_equal and mismatches == 0
+
+        python_time = measure(python_function, arguments)
+        compiled_time = measure(compiled_function, arguments)
+        print('%-22s python %8.4f s  compiled %8.4f s  speedup %6.1fx  mismatches %d' %
+              (name, python_time, compiled_time, python_time / max(compiled_time, 1e-9), mismatches))
+
+    if not all_equal:
+        eprint("Error: Compiled functions results differ from pure python versions!")
+        sys.exit(1)
+
+
+# random pairs, including empty, equal and case differing strings
+def generate_pairs(pairs_count, max_length, rng):
+    pairs = [(u'', u''), (u'', u'a'), (u'a', u'a'), (u'Ala', u'ala')]
+    while len(pairs) < pairs_count:
+        s1 = generate_string(max_length, rng)
+        s2 = generate_string(max_length, rng)
+        if rng.random() < 0.1:
+            s2 = s1
+        elif rng.random() < 0.1:
+            s2 = s1.upper()
+        pairs.append((s1, s2))
+    return pairs[:pairs_count]
+
+
+def generate_string(max_length, rng):
+    return u''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, max_length)))
+
+
+# kernel values are computed in different order by the vectorized python version
+def same_results(python_result, compiled_result):
+    if isinstance(python_result, float):
+        return abs(python_result - compiled_result) <= 1e-12 * max(1.0, abs(python_result))
+    return python_result == compiled_result
+
+
+def measure(function, arguments):
+    start_time = timeit.default_timer()
+    for args in arguments:
+        function(*args)
+    return timeit.default_timer() - start_time
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import timeit
+
+from argparse import ArgumentParser
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+import conf
+from corneferencer import resources, utils
+from corneferencer.utils import eprint
+
+
+# path of java serialized map and whether it maps one element to many
+MAPS = [(conf.LEMMA2SYNONYMS_PATH, True),
+        (conf.LEMMA2HYPERNYMS_PATH, True),
+        (conf.TITLE2LINKS_PATH, True),
+        (conf.TITLE2REDIRECT_PATH, False)]
+
+
+def main():
+    args = parse_arguments()
+    if not args.maps and not args.embeddings:
+        eprint("Error: Nothing to convert, use --maps or --embeddings!")
+        sys.exit(1)
+    if args.maps:
+        convert_maps()
+    if args.embeddings:
+        convert_embeddings()
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Corneferencer: converts resources to formats which load fast.')
+    parser.add_argument('--maps', action='store_true',
+                        dest='maps', default=False,
+                        help='convert java serialized wordnet and wikipedia maps to map bundles')
+    parser.add_argument('--embeddings', action='store_true',
+                        dest='embeddings', default=False,
+                        help='export word vectors of word2vec model to memory-mapped bundle')
+    args = parser.parse_args()
+    return args
+
+
+def convert_maps():
+    for map_path, one2many in MAPS:
+        if not os.path.exists(map_path):
+            eprint("Warning: %s does not exist, skipping!" % map_path)
+            continue
+        start_time = timeit.default_timer()
+        if one2many:
+            this_map = utils.load_one2many_map(map_path)
+        else:
+            this_map = utils.load_one2one_map(map_path)
+        bundle_path = map_path + resources.MAP_BUNDLE_SUFFIX
+        resources.save_map_bundle(this_map, bundle_path, one2many)
+        print('%s -> %s (%d keys, %.2f s)' % (map_path, bundle_path, len(this_map),
+                                             timeit.default_timer() - start_time))
+
+
+def convert_embeddings():
+    if not os.path.exists(conf.W2V_MODEL_PATH):
+        eprint("Warning: %s does not exist, skipping!" % conf.W2V_MODEL_PATH)
+        return
+    start_time = timeit.default_timer()
+    model = utils.load_w2v_model(conf.W2V_MODEL_PATH)
+    words, vectors = get_keyed_vectors(model.wv)
+    bundle_path = conf.W2V_MODEL_PATH + resources.EMBEDDINGS_BUNDLE_SUFFIX
+    resources.save_embeddings_bundle(words, vectors, bundle_path)
+    print('%s -> %s (%d words, %.2f s)' % (conf.W2V_MODEL_PATH, bundle_path, len(words),
+                                          timeit.default_timer() - start_time))
+
+
+# gensim 4 renamed index2word to index_to_key
+def get_keyed_vectors(keyed_vectors):
+    if hasattr(keyed_vectors, 'index_to_key'):
+        words = keyed_vectors.index_to_key
+    else:
+        words = keyed_vectors.index2word
+    return list(words), keyed_vectors.vectors
+
+
+if __name__ == '__main__':
+    main()
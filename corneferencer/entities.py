@@ -1,23 +1,46 @@
-from corneferencer.resolvers import vectors
+import sys
+from array import array
+from collections.abc import Sequence
+
+import numpy
+
+from corneferencer.resolvers import features, vectors
+
+
+# values of int coded token columns
+GENDERS = ['m1', 'm2', 'm3', 'f', 'n', 'unk']
+NUMBERS = ['sg', 'pl', 'unk']
+PERSONS = ['pri', 'sec', 'ter', 'unk']
 
 
 class Text:
 
     def __init__(self, text_id):
         self.__id = text_id
-        self.mentions = []
+        self.__mentions = []
+        self.__mentions_by_id = {}
+        self.coreference_sets = CoreferenceSets()
+
+    @property
+    def mentions(self):
+        return self.__mentions
+
+    @mentions.setter
+    def mentions(self, mentions):
+        self.__mentions = mentions
+        self.__mentions_by_id = {}
+        for mnt in mentions:
+            self.__mentions_by_id.setdefault(mnt.id, mnt)
+            mnt.attach_coreference_sets(self.coreference_sets)
 
     def get_mention_set(self, mnt_id):
-        for mnt in self.mentions:
-            if mnt.id == mnt_id:
-                return mnt.set
+        mnt = self.get_mention(mnt_id)
+        if mnt is not None:
+            return mnt.set
         return None
 
     def get_mention(self, mnt_id):
-        for mnt in self.mentions:
-            if mnt.id == mnt_id:
-                return mnt
-        return None
+        return self.__mentions_by_id.get(mnt_id)
 
     def get_mentions(self):
         return self.mentions
@@ -25,30 +48,214 @@ class Text:
     def get_sets(self):
         sets = {}
         for mnt in self.mentions:
-            if mnt.set and mnt.set in sets:
-                sets[mnt.set].append(mnt)
-            elif mnt.set:
-                sets[mnt.set] = [mnt]
+            mnt_set = mnt.set
+            if mnt_set and mnt_set in sets:
+                sets[mnt_set].append(mnt)
+            elif mnt_set:
+                sets[mnt_set] = [mnt]
         return sets
 
     def merge_sets(self, set1, set2):
-        for mnt in self.mentions:
-            if mnt.set == set1:
-                mnt.set = set2
+        self.coreference_sets.merge(set1, set2)
+
+    def get_mentions_sets(self):
+        return [mnt.set for mnt in self.mentions]
+
+    # mentions sets are replaced with given ones (in mentions order), e.g. input sets before resolving text again
+    def set_mentions_sets(self, sets):
+        self.coreference_sets = CoreferenceSets()
+        for mnt, set_id in zip(self.mentions, sets):
+            mnt.attach_coreference_sets(self.coreference_sets)
+            mnt.set = set_id
+
+
+# union-find over set ids, mentions keep nodes of their sets; set ids are live labels,
+# after merging set1 into set2 set1 id is free and may start a new set
+class CoreferenceSets:
+
+    def __init__(self):
+        self.parents = []
+        self.sizes = []
+        self.set_ids = []
+        self.nodes = {}
+
+    def get_node(self, set_id):
+        if set_id not in self.nodes:
+            node = len(self.parents)
+            self.parents.append(node)
+            self.sizes.append(1)
+            self.set_ids.append(set_id)
+            self.nodes[set_id] = node
+        return self.nodes[set_id]
+
+    def find(self, node):
+        root = node
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[node] != root:
+            self.parents[node], node = root, self.parents[node]
+        return root
+
+    def get_set_id(self, node):
+        return self.set_ids[self.find(node)]
+
+    def merge(self, set1, set2):
+        if set1 == set2 or set1 not in self.nodes:
+            return
+        root1 = self.nodes.pop(set1)
+        root2 = self.get_node(set2)
+        if self.sizes[root1] > self.sizes[root2]:
+            root1, root2 = root2, root1
+        self.parents[root1] = root2
+        self.sizes[root2] += self.sizes[root1]
+        self.set_ids[root2] = set2
+        self.nodes[set2] = root2
+
+
+# tokens of a document as parallel columns, strings are interned and tags are int coded;
+# tokens are accessed through Token and Tokens views, which behave like the word dicts
+# ({'id': ..., 'orth': ..., 'base': ...}) and lists of them
+class TokensTable:
+
+    def __init__(self):
+        self.ids = []
+        self.orths = []
+        self.bases = []
+        self.msds = []
+        self.ctags = array('H')
+        self.genders = array('B')
+        self.numbers = array('B')
+        self.persons = array('B')
+        self.hasnps = array('B')
+        self.lastinsent = array('B')
+        self.lastinpar = array('B')
+
+        self.ctag_values = []
+        self.ctag_codes = {}
+
+        self.string_columns = {'id': self.ids, 'orth': self.orths, 'base': self.bases, 'msd': self.msds}
+        self.flag_columns = {'hasnps': self.hasnps, 'lastinsent': self.lastinsent, 'lastinpar': self.lastinpar}
+        self.coded_columns = {'ctag': (self.ctags, self.ctag_values),
+                              'gender': (self.genders, GENDERS),
+                              'number': (self.numbers, NUMBERS),
+                              'person': (self.persons, PERSONS)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, position):
+        return Token(self, position)
+
+    # returns position of the added token
+    def append(self, idx, orth, base, hasnps, lastinsent, lastinpar, ctag, msd, gender, number, person):
+        self.ids.append(sys.intern(idx))
+        self.orths.append(sys.intern(orth) if orth is not None else None)
+        self.bases.append(sys.intern(base))
+        self.msds.append(sys.intern(msd))
+        if ctag not in self.ctag_codes:
+            self.ctag_codes[ctag] = len(self.ctag_values)
+            self.ctag_values.append(ctag)
+        self.ctags.append(self.ctag_codes[ctag])
+        self.genders.append(GENDERS.index(gender))
+        self.numbers.append(NUMBERS.index(number))
+        self.persons.append(PERSONS.index(person))
+        self.hasnps.append(hasnps)
+        self.lastinsent.append(lastinsent)
+        self.lastinpar.append(lastinpar)
+        return len(self.ids) - 1
+
+    def get_value(self, position, key):
+        if key in self.string_columns:
+            return self.string_columns[key][position]
+        elif key in self.flag_columns:
+            return bool(self.flag_columns[key][position])
+        codes, values = self.coded_columns[key]
+        return values[codes[position]]
+
+    def set_flag(self, position, key, value):
+        self.flag_columns[key][position] = value
+
+    def get_tokens(self, positions):
+        positions = array('l', positions)
+        return Tokens(self, positions, 0, len(positions))
+
+
+class Token:
+
+    __slots__ = ('table', 'position')
+
+    def __init__(self, table, position):
+        self.table = table
+        self.position = position
+
+    def __getitem__(self, key):
+        return self.table.get_value(self.position, key)
+
+    def __eq__(self, other):
+        return isinstance(other, Token) and self.table is other.table and self.position == other.position
+
+    def __hash__(self):
+        return hash(self.position)
+
+    def __repr__(self):
+        return 'Token(%r, %r)' % (self['id'], self['orth'])
+
+
+# tokens at positions[start:stop], positions may be shared by many views (e.g. all document tokens)
+class Tokens(Sequence):
+
+    __slots__ = ('table', 'positions', 'start', 'stop')
+
+    def __init__(self, table, positions, start, stop):
+        self.table = table
+        self.positions = positions
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indices = range(self.start, self.stop)[index]
+            if indices.step == 1:
+                return Tokens(self.table, self.positions, indices.start, max(indices.start, indices.stop))
+            return self.table.get_tokens(self.positions[idx] for idx in indices)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('tokens index out of range')
+        return Token(self.table, self.positions[self.start + index])
+
+    def __iter__(self):
+        for idx in range(self.start, self.stop):
+            yield Token(self.table, self.positions[idx])
 
 
 class Mention:
 
+    __slots__ = ('id', 'coreference_sets', 'set_node', 'assigned_set', 'text', 'lemmatized_text',
+                 'words', 'words_ids', 'span', 'head_orth', 'head', 'dominant', 'node',
+                 'prec_context', 'follow_context', 'sentence', 'position_in_mentions',
+                 'start_in_words', 'end_in_words', 'rarest', 'paragraph_id', 'sentence_id',
+                 'first_in_sentence', 'first_in_paragraph', 'tokens_vectors',
+                 'lower_text', 'lower_lemmatized_text', 'lower_head_orth', 'is_upper',
+                 'initials', 'abbrev', 'words_bases', 'features')
+
     def __init__(self, mnt_id, text, lemmatized_text, words, span,
                  head_orth, head, dominant, node, prec_context,
                  follow_context, sentence, position_in_mentions,
                  start_in_words, end_in_words, rarest, paragraph_id, sentence_id,
-                 first_in_sentence, first_in_paragraph, set_id=''):
+                 first_in_sentence, first_in_paragraph, set_id='', tokens_vectors=None):
         self.id = mnt_id
+        self.coreference_sets = None
+        self.set_node = None
         self.set = set_id
         self.text = text
         self.lemmatized_text = lemmatized_text
         self.words = words
+        # ids of mention words, mentions may be discontinuous
+        self.words_ids = frozenset(word['id'] for word in words)
         self.span = span
         self.head_orth = head_orth
         self.head = head
@@ -65,4 +272,35 @@ class Mention:
         self.sentence_id = sentence_id
         self.first_in_sentence = first_in_sentence
         self.first_in_paragraph = first_in_paragraph
-        self.features = vectors.get_mention_features(self)
+        self.tokens_vectors = tokens_vectors
+
+        # string signatures compared by pair features, lowercased forms are interned,
+        # so that comparisons of equal strings are identity checks
+        self.lower_text = sys.intern(text.lower())
+        self.lower_lemmatized_text = sys.intern(lemmatized_text.lower())
+        self.lower_head_orth = sys.intern(head_orth.lower())
+        self.is_upper = text.upper() == text
+        self.initials = features.get_initials(text)
+        self.abbrev = features.get_abbrev(self)
+        self.words_bases = frozenset(word['base'] for word in words)
+
+        self.features = numpy.asarray(vectors.get_mention_features(self), dtype=numpy.float32)
+
+    # empty set ids ('' or None) are kept as they are
+    @property
+    def set(self):
+        if self.set_node is None:
+            return self.assigned_set
+        return self.coreference_sets.get_set_id(self.set_node)
+
+    @set.setter
+    def set(self, set_id):
+        self.assigned_set = set_id
+        self.set_node = None
+        if set_id and self.coreference_sets is not None:
+            self.set_node = self.coreference_sets.get_node(set_id)
+
+    def attach_coreference_sets(self, coreference_sets):
+        set_id = self.set
+        self.coreference_sets = coreference_sets
+        self.set = set_id
@@ -0,0 +1,79 @@
+from array import array
+
+import conf
+from corneferencer.entities import Tokens
+
+
+# positions of document words built once per text, so that mention context lookups
+# do not scan the whole document; tokens are words which are not ignored (interps);
+# words are Tokens of the document tokens table, tokens and contexts are views of them
+class WordsIndex:
+
+    def __init__(self, words, word_to_ignore):
+        self.words = words
+        self.positions = {}
+        tokens_positions = array('l')
+        # number of tokens before given word
+        self.tokens_before = array('l')
+        # sentence and paragraph ids are numbers of sentences and paragraphs ended before given word
+        self.sentence_ids = array('l')
+        self.paragraph_ids = array('l')
+        self.sentence_starts = array('l')
+        self.sentence_ends = array('l', [0] * len(words))
+
+        table = words.table
+        sentence_id = 0
+        paragraph_id = 0
+        sentence_start = 0
+        for idx, word in enumerate(words):
+            self.positions.setdefault(table.ids[word.position], idx)
+            self.tokens_before.append(len(tokens_positions))
+            if not word_to_ignore(word):
+                tokens_positions.append(word.position)
+            self.sentence_ids.append(sentence_id)
+            self.paragraph_ids.append(paragraph_id)
+            self.sentence_starts.append(sentence_start)
+            if table.lastinsent[word.position]:
+                sentence_id += 1
+                sentence_start = idx + 1
+            if table.lastinpar[word.position]:
+                paragraph_id += 1
+        self.tokens_before.append(len(tokens_positions))
+        self.tokens = Tokens(table, tokens_positions, 0, len(tokens_positions))
+
+        sentence_end = len(words) - 1
+        for idx in reversed(range(len(words))):
+            if table.lastinsent[words.positions[words.start + idx]]:
+                sentence_end = idx
+            self.sentence_ends[idx] = sentence_end
+
+    def __len__(self):
+        return len(self.words)
+
+    def get_position(self, word_id):
+        return self.positions[word_id]
+
+    # tokens from start to end word (inclusive), up to the document end if end word is unknown
+    def get_tokens(self, start, end=None):
+        if end is None:
+            return self.tokens[self.tokens_before[start]:]
+        return self.tokens[self.tokens_before[start]:self.tokens_before[end + 1]]
+
+    def get_prec_context(self, mention_start):
+        context_end = self.tokens_before[mention_start]
+        return self.tokens[max(0, context_end - conf.CONTEXT):context_end]
+
+    def get_follow_context(self, mention_end):
+        context_start = self.tokens_before[mention_end + 1]
+        return self.tokens[context_start:context_start + conf.CONTEXT]
+
+    def get_sentence(self, word_idx):
+        sentence_start = self.sentence_starts[word_idx]
+        sentence_end = self.sentence_ends[word_idx]
+        return self.get_tokens(sentence_start, sentence_end)
+
+    def is_first_in_sentence(self, word_idx):
+        return word_idx == 0 or self.words[word_idx - 1]['lastinsent']
+
+    def is_first_in_paragraph(self, word_idx):
+        return word_idx == 0 or self.words[word_idx - 1]['lastinpar']
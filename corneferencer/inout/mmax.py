@@ -1,13 +1,18 @@
 import os
-import shutil
 
 from lxml import etree
 
 import conf
-from corneferencer.entities import Mention, Text
+from corneferencer.entities import Mention, Text, TokensTable
+from corneferencer.inout.index import WordsIndex
+from corneferencer.resolvers import features
+from corneferencer.utils import copy_file
 
+MENTION_NS = 'www.eml.org/NameSpaces/mention'
+MARKABLE_TAG = '{%s}markable' % MENTION_NS
 
-def read(inpath, clear_mentions=conf.CLEAR_INPUT):
+
+def read(inpath, clear_mentions=conf.CLEAR_INPUT, keep_nodes=conf.KEEP_MENTION_NODES):
     textname = os.path.splitext(os.path.basename(inpath))[0]
     textdir = os.path.dirname(inpath)
 
@@ -15,18 +20,17 @@ def read(inpath, clear_mentions=conf.CLEAR_INPUT):
     words_path = os.path.join(textdir, '%s_words.xml' % textname)
 
     text = Text(textname)
-    text.mentions = read_mentions(mentions_path, words_path, clear_mentions)
+    text.mentions = read_mentions(mentions_path, words_path, clear_mentions, keep_nodes)
     return text
 
 
-def read_mentions(mentions_path, words_path, clear_mentions=conf.CLEAR_INPUT):
+def read_mentions(mentions_path, words_path, clear_mentions=conf.CLEAR_INPUT, keep_nodes=conf.KEEP_MENTION_NODES):
     mentions = []
-    mentions_tree = etree.parse(mentions_path)
-    markables = mentions_tree.xpath("//ns:markable",
-                                    namespaces={'ns': 'www.eml.org/NameSpaces/mention'})
-    words = get_words(words_path)
+    tokens_table = get_words(words_path)
+    words_index = WordsIndex(tokens_table.get_tokens(range(len(tokens_table))), word_to_ignore)
+    tokens_vectors = features.get_tokens_vectors(words_index.tokens)
 
-    for idx, markable in enumerate(markables):
+    for idx, markable in enumerate(iter_markables(mentions_path, keep_nodes)):
         span = markable.attrib['span']
 
         dominant = ''
@@ -34,26 +38,27 @@ def read_mentions(mentions_path, words_path, clear_mentions=conf.CLEAR_INPUT):
             dominant = markable.attrib['dominant']
 
         head_orth = markable.attrib['mention_head']
-        mention_words = span_to_words(span, words)
+        fragments = span_to_fragments(span, words_index)
+        mention_words = fragments_to_words(fragments, tokens_table)
 
         (prec_context, follow_context, sentence,
          mnt_start_position, mnt_end_position,
          paragraph_id, sentence_id,
-         first_in_sentence, first_in_paragraph) = get_context(mention_words, words)
+         first_in_sentence, first_in_paragraph) = get_context(mention_words, words_index)
 
         head = get_head(head_orth, mention_words)
         mention_group = ''
         if markable.attrib['mention_group'] != 'empty' and not clear_mentions:
             mention_group = markable.attrib['mention_group']
         mention = Mention(mnt_id=markable.attrib['id'],
-                          text=span_to_text(span, words, 'orth'),
-                          lemmatized_text=span_to_text(span, words, 'base'),
+                          text=fragments_to_text(fragments, 'orth'),
+                          lemmatized_text=fragments_to_text(fragments, 'base'),
                           words=mention_words,
                           span=span,
                           head_orth=head_orth,
                           head=head,
                           dominant=dominant,
-                          node=markable,
+                          node=markable if keep_nodes else None,
                           prec_context=prec_context,
                           follow_context=follow_context,
                           sentence=sentence,
@@ -65,16 +70,31 @@ def read_mentions(mentions_path, words_path, clear_mentions=conf.CLEAR_INPUT):
                           sentence_id=sentence_id,
                           first_in_sentence=first_in_sentence,
                           first_in_paragraph=first_in_paragraph,
-                          set_id=mention_group)
+                          set_id=mention_group,
+                          tokens_vectors=tokens_vectors)
         mentions.append(mention)
 
     return mentions
 
 
+# markables are streamed and cleared after reading unless mentions keep their nodes
+def iter_markables(mentions_path, keep_nodes=conf.KEEP_MENTION_NODES):
+    for event, markable in etree.iterparse(mentions_path, tag=MARKABLE_TAG):
+        yield markable
+        if not keep_nodes:
+            clear_element(markable)
+
+
+def clear_element(element):
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+# words file is streamed, words are kept in tokens table only
 def get_words(filepath):
-    tree = etree.parse(filepath)
-    words = []
-    for word in tree.xpath("//word"):
+    words = TokensTable()
+    for event, word in etree.iterparse(filepath, tag='word'):
         hasnps = False
         if (('hasnps' in word.attrib and word.attrib['hasnps'] == 'true') or
                 ('hasNps' in word.attrib and word.attrib['hasNps'] == 'true')):
@@ -87,171 +107,84 @@ def get_words(filepath):
         if (('lastinpar' in word.attrib and word.attrib['lastinpar'] == 'true') or
                 ('lastInPar' in word.attrib and word.attrib['lastInPar'] == 'true')):
             lastinpar = True
-        words.append({'id': word.attrib['id'],
-                      'orth': word.text,
-                      'base': word.attrib['base'],
-                      'hasnps': hasnps,
-                      'lastinsent': lastinsent,
-                      'lastinpar': lastinpar,
-                      'ctag': word.attrib['ctag'],
-                      'msd': word.attrib['msd'],
-                      'gender': get_gender(word.attrib['msd']),
-                      'person': get_person(word.attrib['msd']),
-                      'number': get_number(word.attrib['msd'])})
+        words.append(idx=word.attrib['id'],
+                     orth=word.text,
+                     base=word.attrib['base'],
+                     hasnps=hasnps,
+                     lastinsent=lastinsent,
+                     lastinpar=lastinpar,
+                     ctag=word.attrib['ctag'],
+                     msd=word.attrib['msd'],
+                     gender=get_gender(word.attrib['msd']),
+                     person=get_person(word.attrib['msd']),
+                     number=get_number(word.attrib['msd']))
+        clear_element(word)
     return words
 
 
-def span_to_words(span, words):
-    fragments = span.split(',')
-    mention_parts = []
-    for fragment in fragments:
-        mention_parts.extend(fragment_to_words(fragment, words))
-    return mention_parts
+# span fragments are resolved once to words, single word fragments keep interps, which are part of mention text
+def span_to_fragments(span, words_index):
+    return [fragment_to_words(fragment, words_index) for fragment in span.split(',')]
 
 
-def fragment_to_words(fragment, words):
-    mention_parts = []
+def fragment_to_words(fragment, words_index):
     if '..' in fragment:
-        mention_parts.extend(get_multiword(fragment, words))
-    else:
-        mention_parts.extend(get_word(fragment, words))
-    return mention_parts
+        return get_multiword(fragment, words_index)
+    return get_word(fragment, words_index)
 
 
-def get_multiword(fragment, words):
-    mention_parts = []
+def get_multiword(fragment, words_index):
     boundaries = fragment.split('..')
-    start_id = boundaries[0]
-    end_id = boundaries[1]
-    in_string = False
-    for word in words:
-        if word['id'] == start_id:
-            in_string = True
-        if in_string and not word_to_ignore(word):
-            mention_parts.append(word)
-        if word['id'] == end_id:
-            break
-    return mention_parts
+    start = words_index.positions.get(boundaries[0])
+    end = words_index.positions.get(boundaries[1])
+    if start is None or (end is not None and end < start):
+        return []
+    return words_index.get_tokens(start, end)
 
 
-def get_word(word_id, words):
-    for word in words:
-        if word['id'] == word_id:
-            if not word_to_ignore(word):
-                return [word]
-            else:
-                return []
+def get_word(word_id, words_index):
+    if word_id in words_index.positions:
+        return [words_index.words[words_index.get_position(word_id)]]
     return []
 
 
+def fragments_to_words(fragments, tokens_table):
+    return tokens_table.get_tokens(word.position for fragment in fragments for word in fragment
+                                   if not word_to_ignore(word))
+
+
+def fragments_to_text(fragments, form):
+    return u' [...] '.join(to_text(fragment, form) for fragment in fragments)
+
+
 def word_to_ignore(word):
     if word['ctag'] == 'interp':
         return True
     return False
 
 
-def get_context(mention_words, words):
-    paragraph_id = 0
-    sentence_id = 0
+def get_context(mention_words, words_index):
     prec_context = []
-    follow_context = []
-    sentence = []
     mnt_start_position = -1
-    mnt_end_position = -1
-    first_word = mention_words[0]
-    last_word = mention_words[-1]
     first_in_sentence = False
     first_in_paragraph = False
-    for idx, word in enumerate(words):
-        if word['id'] == first_word['id']:
-            prec_context = get_prec_context(idx, words)
-            mnt_start_position = get_mention_start(first_word, words)
-            if idx == 0 or words[idx-1]['lastinsent']:
-                first_in_sentence = True
-            if idx == 0 or words[idx-1]['lastinpar']:
-                first_in_paragraph = True
-        if word['id'] == last_word['id']:
-            follow_context = get_follow_context(idx, words)
-            sentence = get_sentence(idx, words)
-            mnt_end_position = get_mention_end(last_word, words)
-            break
-        if word['lastinsent']:
-            sentence_id += 1
-        if word['lastinpar']:
-            paragraph_id += 1
+    start = words_index.get_position(mention_words[0]['id'])
+    end = words_index.get_position(mention_words[-1]['id'])
+    # words are searched from the document start, a mention ending before its first word has no start
+    if start <= end:
+        prec_context = words_index.get_prec_context(start)
+        mnt_start_position = words_index.tokens_before[start + 1]
+        first_in_sentence = words_index.is_first_in_sentence(start)
+        first_in_paragraph = words_index.is_first_in_paragraph(start)
+    follow_context = words_index.get_follow_context(end)
+    sentence = words_index.get_sentence(end)
+    mnt_end_position = words_index.tokens_before[end + 1]
+    paragraph_id = words_index.paragraph_ids[end]
+    sentence_id = words_index.sentence_ids[end]
     return (prec_context, follow_context, sentence, mnt_start_position, mnt_end_position,
             paragraph_id, sentence_id, first_in_sentence, first_in_paragraph)
 
 
-def get_prec_context(mention_start, words):
-    context = []
-    context_start = mention_start - 1
-    while context_start >= 0:
-        if not word_to_ignore(words[context_start]):
-            context.append(words[context_start])
-        if len(context) == conf.CONTEXT:
-            break
-        context_start -= 1
-    context.reverse()
-    return context
-
-
-def get_mention_start(first_word, words):
-    start = 0
-    for word in words:
-        if not word_to_ignore(word):
-            start += 1
-        if word['id'] == first_word['id']:
-            break
-    return start
-
-
-def get_mention_end(last_word, words):
-    end = 0
-    for word in words:
-        if not word_to_ignore(word):
-            end += 1
-        if word['id'] == last_word['id']:
-            break
-    return end
-
-
-def get_follow_context(mention_end, words):
-    context = []
-    context_end = mention_end + 1
-    while context_end < len(words):
-        if not word_to_ignore(words[context_end]):
-            context.append(words[context_end])
-        if len(context) == conf.CONTEXT:
-            break
-        context_end += 1
-    return context
-
-
-def get_sentence(word_idx, words):
-    sentence_start = get_sentence_start(words, word_idx)
-    sentence_end = get_sentence_end(words, word_idx)
-    sentence = [word for word in words[sentence_start:sentence_end + 1] if not word_to_ignore(word)]
-    return sentence
-
-
-def get_sentence_start(words, word_idx):
-    search_start = word_idx
-    while word_idx >= 0:
-        if words[word_idx]['lastinsent'] and search_start != word_idx:
-            return word_idx + 1
-        word_idx -= 1
-    return 0
-
-
-def get_sentence_end(words, word_idx):
-    while word_idx < len(words):
-        if words[word_idx]['lastinsent']:
-            return word_idx
-        word_idx += 1
-    return len(words) - 1
-
-
 def get_head(head_orth, words):
     for word in words:
         if word['orth'].lower() == head_orth.lower() or word['orth'] == head_orth:
@@ -259,38 +192,6 @@ def get_head(head_orth, words):
     return None
 
 
-def span_to_text(span, words, form):
-    fragments = span.split(',')
-    mention_parts = []
-    for fragment in fragments:
-        mention_parts.append(fragment_to_text(fragment, words, form))
-    return u' [...] '.join(mention_parts)
-
-
-def fragment_to_text(fragment, words, form):
-    if '..' in fragment:
-        text = get_multiword_text(fragment, words, form)
-    else:
-        text = get_one_word_text(fragment, words, form)
-    return text
-
-
-def get_multiword_text(fragment, words, form):
-    mention_parts = []
-    boundaries = fragment.split('..')
-    start_id = boundaries[0]
-    end_id = boundaries[1]
-    in_string = False
-    for word in words:
-        if word['id'] == start_id:
-            in_string = True
-        if in_string and not word_to_ignore(word):
-            mention_parts.append(word)
-        if word['id'] == end_id:
-            break
-    return to_text(mention_parts, form)
-
-
 def to_text(words, form):
     text = ''
     for idx, word in enumerate(words):
@@ -301,11 +202,6 @@ def to_text(words, form):
     return text
 
 
-def get_one_word_text(word_id, words, form):
-    this_word = next(word for word in words if word['id'] == word_id)
-    return this_word[form]
-
-
 def get_gender(msd):
     tags = msd.split(':')
     if 'm1' in tags:
@@ -357,30 +253,30 @@ def get_rarest_word(words):
     return rarest_word
 
 
-def write(inpath, outpath, text):
+def write(inpath, outpath, text, link_layers=conf.LINK_LAYERS):
     textname = os.path.splitext(os.path.basename(inpath))[0]
     intextdir = os.path.dirname(inpath)
     outtextdir = os.path.dirname(outpath)
 
     in_mmax_path = os.path.join(intextdir, '%s.mmax' % textname)
     out_mmax_path = os.path.join(outtextdir, '%s.mmax' % textname)
-    copy_mmax(in_mmax_path, out_mmax_path)
+    copy_mmax(in_mmax_path, out_mmax_path, link_layers)
 
     in_words_path = os.path.join(intextdir, '%s_words.xml' % textname)
     out_words_path = os.path.join(outtextdir, '%s_words.xml' % textname)
-    copy_words(in_words_path, out_words_path)
+    copy_words(in_words_path, out_words_path, link_layers)
 
     in_mentions_path = os.path.join(intextdir, '%s_mentions.xml' % textname)
     out_mentions_path = os.path.join(outtextdir, '%s_mentions.xml' % textname)
     write_mentions(in_mentions_path, out_mentions_path, text)
 
 
-def copy_mmax(src, dest):
-    shutil.copyfile(src, dest)
+def copy_mmax(src, dest, link=False):
+    copy_file(src, dest, link)
 
 
-def copy_words(src, dest):
-    shutil.copyfile(src, dest)
+def copy_words(src, dest, link=False):
+    copy_file(src, dest, link)
 
 
 def write_mentions(inpath, outpath, text):
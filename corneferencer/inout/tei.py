@@ -1,13 +1,15 @@
 import gzip
 import os
-import shutil
 from collections import defaultdict
+from contextlib import contextmanager
 
 from lxml import etree
 
 import conf
-from corneferencer.entities import Mention, Text
-from corneferencer.utils import eprint
+from corneferencer.entities import Mention, Text, TokensTable
+from corneferencer.inout.index import WordsIndex
+from corneferencer.resolvers import features
+from corneferencer.utils import copy_file, eprint
 
 NKJP_NS = 'http://www.nkjp.pl/ns/1.0'
 TEI_NS = 'http://www.tei-c.org/ns/1.0'
@@ -16,9 +18,19 @@ XML_NS = 'http://www.w3.org/XML/1998/namespace'
 NSMAP = {None: TEI_NS,
          'nkjp': NKJP_NS,
          'xi': XI_NS}
+# indentation of written coreference layer
+INDENT = '  '
 
+BODY_TAG = '{%s}body' % TEI_NS
+P_TAG = '{%s}p' % TEI_NS
+S_TAG = '{%s}s' % TEI_NS
+SEG_TAG = '{%s}seg' % TEI_NS
+F_TAG = '{%s}f' % TEI_NS
+PTR_TAG = '{%s}ptr' % TEI_NS
 
-def read(inpath, clear_mentions=conf.CLEAR_INPUT, add_single_mentions_to_cluster=True):
+
+def read(inpath, clear_mentions=conf.CLEAR_INPUT, add_single_mentions_to_cluster=True,
+         keep_nodes=conf.KEEP_MENTION_NODES):
     textname = os.path.basename(inpath)
     print(f"tei.read {inpath}")
 
@@ -39,13 +51,13 @@ def read(inpath, clear_mentions=conf.CLEAR_INPUT, add_single_mentions_to_cluster
         return None
 
     if os.path.exists(ann_morphosyntax):
-        (segments, segments_ids) = read_morphosyntax(ann_morphosyntax)
+        (tokens_table, segments, segments_ids) = read_morphosyntax(ann_morphosyntax)
     else:
         eprint("Error: missing morphosyntax layer for text %s!" % textname)
         return None
 
     if os.path.exists(ann_mentions):
-        text.mentions = read_mentions(ann_mentions, segments, segments_ids)
+        text.mentions = read_mentions(ann_mentions, tokens_table, segments, segments_ids, keep_nodes)
     else:
         eprint("Error: missing mentions layer for text %s!" % textname)
         return None
@@ -53,7 +65,7 @@ def read(inpath, clear_mentions=conf.CLEAR_INPUT, add_single_mentions_to_cluster
     if os.path.exists(ann_coreference) and not clear_mentions:
         add_coreference_layer(ann_coreference, text)
 
-    text.segments = [segment['orth'] for k, segment in segments.items()]
+    text.segments = [tokens_table.orths[position] for position in segments.values()]
 
     mentions_sets = defaultdict(list)
 
@@ -74,42 +86,51 @@ def read(inpath, clear_mentions=conf.CLEAR_INPUT, add_single_mentions_to_cluster
     return text
 
 
-# morphosyntax
+# morphosyntax, segments are positions of segments in the tokens table
 def read_morphosyntax(ann_archive):
+    tokens_table = TokensTable()
     segments_dict = {}
     segments_ids = []
-    ann_file = gzip.open(ann_archive, 'rb')
-    parser = etree.XMLParser(encoding="utf-8")
-    tree = etree.parse(ann_file, parser)
-    body = tree.xpath('//xmlns:body', namespaces={'xmlns': TEI_NS})[0]
-
-    paragraphs = body.xpath(".//xmlns:p", namespaces={'xmlns': TEI_NS})
-    for par in paragraphs:
-        sentences = par.xpath(".//xmlns:s", namespaces={'xmlns': TEI_NS})
-        for sent_id, sent in enumerate(sentences):
-            segments = sent.xpath(".//xmlns:seg", namespaces={'xmlns': TEI_NS})
-            for seg_id, seg in enumerate(segments):
-                lastinsent = False
-                lastinpar = False
-                if seg_id == len(segments) - 1:
-                    lastinsent = True
-                    if sent_id == len(sentences) - 1:
-                        lastinpar = True
-                segment = read_segment(seg, lastinsent, lastinpar)
-                segments_dict[segment['id']] = segment
-                segments_ids.append(segment['id'])
-
-    return segments_dict, segments_ids
-
-
-def read_segment(seg, lastinsent, lastinpar):
+    par_depth = 0
+    sent_depth = 0
+    sent_start = 0
+    last_sent_segment = None
+    for event, element in iterparse_body(ann_archive, ['p', 's', 'seg']):
+        if element.tag == P_TAG:
+            par_depth += 1 if event == 'start' else -1
+            if event == 'end':
+                if last_sent_segment is not None:
+                    tokens_table.set_flag(last_sent_segment, 'lastinpar', True)
+                    last_sent_segment = None
+                clear_element(element)
+        elif element.tag == S_TAG and par_depth > 0:
+            sent_depth += 1 if event == 'start' else -1
+            if event == 'start':
+                sent_start = len(segments_ids)
+            else:
+                last_sent_segment = None
+                if len(segments_ids) > sent_start:
+                    last_sent_segment = segments_dict[segments_ids[-1]]
+                    tokens_table.set_flag(last_sent_segment, 'lastinsent', True)
+                clear_element(element)
+        elif element.tag == SEG_TAG and sent_depth > 0 and event == 'end':
+            segment = read_segment(element, tokens_table, lastinsent=False, lastinpar=False)
+            segment_id = tokens_table.ids[segment]
+            segments_dict[segment_id] = segment
+            segments_ids.append(segment_id)
+            clear_element(element)
+
+    return tokens_table, segments_dict, segments_ids
+
+
+def read_segment(seg, tokens_table, lastinsent, lastinpar):
     hasnps = False
     base = ''
     ctag = ''
     msd = ''
     orth = ''
     idx = seg.attrib['{%s}id' % XML_NS]
-    for f in seg.xpath(".//xmlns:f", namespaces={'xmlns': TEI_NS}):
+    for f in seg.iter(F_TAG):
         if f.attrib['name'] == 'orth':
             orth = get_f_string(f)
         elif f.attrib['name'] == 'nps':
@@ -117,17 +138,17 @@ def read_segment(seg, lastinsent, lastinpar):
         elif f.attrib['name'] == 'interpretation':
             interpretation = get_f_string(f)
             (base, ctag, msd) = parse_interpretation(interpretation)
-    return {'id': idx,
-            'orth': orth,
-            'base': base,
-            'hasnps': hasnps,
-            'lastinsent': lastinsent,
-            'lastinpar': lastinpar,
-            'ctag': ctag,
-            'msd': msd,
-            'number': get_number(msd),
-            'person': get_person(msd),
-            'gender': get_gender(msd)}
+    return tokens_table.append(idx=idx,
+                               orth=orth,
+                               base=base,
+                               hasnps=hasnps,
+                               lastinsent=lastinsent,
+                               lastinpar=lastinpar,
+                               ctag=ctag,
+                               msd=msd,
+                               number=get_number(msd),
+                               person=get_person(msd),
+                               gender=get_gender(msd))
 
 
 def get_f_string(f):
@@ -197,47 +218,60 @@ def get_number(msd):
 
 
 # mentions
-def read_mentions(ann_archive, segments, segments_ids):
+def read_mentions(ann_archive, tokens_table, segments, segments_ids, keep_nodes=conf.KEEP_MENTION_NODES):
     mentions = []
 
-    ann_file = gzip.open(ann_archive, 'rb')
-    parser = etree.XMLParser(encoding="utf-8")
-    tree = etree.parse(ann_file, parser)
-    body = tree.xpath('//xmlns:body', namespaces={'xmlns': TEI_NS})[0]
+    words_index = WordsIndex(tokens_table.get_tokens(segments[morph_id] for morph_id in segments_ids),
+                             word_to_ignore)
+    tokens_vectors = features.get_tokens_vectors(words_index.tokens)
 
-    paragraphs = body.xpath(".//xmlns:p", namespaces={'xmlns': TEI_NS})
+    # mentions layer elements are cleared unless mentions keep their nodes
+    par_id = -1
+    par_depth = 0
     mnt_id = 0
-    for par_id, par in enumerate(paragraphs):
-        mention_nodes = par.xpath(".//xmlns:seg", namespaces={'xmlns': TEI_NS})
-        for mnt in mention_nodes:
+    for event, element in iterparse_body(ann_archive, ['p', 'seg']):
+        if element.tag == P_TAG:
+            if event == 'start':
+                par_id += 1
+                par_depth += 1
+            else:
+                par_depth -= 1
+                if not keep_nodes:
+                    clear_element(element)
+        elif par_depth > 0 and event == 'end':
             mnt_id += 1
-            mention = get_mention(mnt, mnt_id, segments, segments_ids, par_id, sentence_id=None)
+            mention = get_mention(element, mnt_id, tokens_table, segments, words_index, par_id, sentence_id=None,
+                                  tokens_vectors=tokens_vectors, keep_node=keep_nodes)
             mentions.append(mention)
+            if not keep_nodes:
+                clear_element(element)
 
     return mentions
 
 
-def get_mention(mention, mnt_id, segments, segments_ids, paragraph_id, sentence_id):
+def get_mention(mention, mnt_id, tokens_table, segments, words_index, paragraph_id, sentence_id,
+                tokens_vectors=None, keep_node=True):
     idx = mention.attrib['{%s}id' % XML_NS]
 
     mnt_segments = []
-    for ptr in mention.xpath(".//xmlns:ptr", namespaces={'xmlns': TEI_NS}):
+    for ptr in mention.iter(PTR_TAG):
         seg_id = ptr.attrib['target'].split('#')[-1]
         sentence_id = int(seg_id.split('.')[-2]) if sentence_id is None else sentence_id
-        if not word_to_ignore(segments[seg_id]):
+        if not word_to_ignore(tokens_table[segments[seg_id]]):
             mnt_segments.append(segments[seg_id])
 
     semh = None
-    for f in mention.xpath(".//xmlns:f", namespaces={'xmlns': TEI_NS}):
+    for f in mention.iter(F_TAG):
         if f.attrib['name'] == 'semh':
             semh_id = get_fval(f).split('#')[-1]
-            semh = segments[semh_id]
+            semh = tokens_table[segments[semh_id]]
 
     if len(mnt_segments) == 0:
-        mnt_segments.append(semh)
+        mnt_segments.append(semh.position)
+    mnt_segments = tokens_table.get_tokens(mnt_segments)
 
     (sent_segments, prec_context, follow_context,
-     first_in_sentence, first_in_paragraph) = get_context(mnt_segments, segments, segments_ids)
+     first_in_sentence, first_in_paragraph) = get_context(mnt_segments, words_index)
 
     mention = Mention(mnt_id=idx,
                       text=to_text(mnt_segments, 'orth'),
@@ -246,97 +280,41 @@ def get_mention(mention, mnt_id, segments, segments_ids, paragraph_id, sentence_
                       span=None,
                       head_orth=semh['orth'],
                       head=semh,
-                      node=mention,
+                      node=mention if keep_node else None,
                       prec_context=prec_context,
                       follow_context=follow_context,
                       sentence=sent_segments,
                       sentence_id=sentence_id,
                       paragraph_id=paragraph_id,
                       position_in_mentions=mnt_id,
-                      start_in_words=segments_ids.index(mnt_segments[0]['id']),
-                      end_in_words=segments_ids.index(mnt_segments[-1]['id']),
+                      start_in_words=words_index.get_position(mnt_segments[0]['id']),
+                      end_in_words=words_index.get_position(mnt_segments[-1]['id']),
                       rarest=get_rarest_word(mnt_segments),
                       first_in_sentence=first_in_sentence,
                       first_in_paragraph=first_in_paragraph,
                       set_id=None,
-                      dominant=None, )
+                      dominant=None,
+                      tokens_vectors=tokens_vectors)
 
     return mention
 
 
-def get_context(mention_words, segments, segments_ids):
+def get_context(mention_words, words_index):
     prec_context = []
-    follow_context = []
-    sentence = []
-    first_word = mention_words[0]
-    last_word = mention_words[-1]
     first_in_sentence = False
     first_in_paragraph = False
-    for idx, morph_id in enumerate(segments_ids):
-        word = segments[morph_id]
-        if word['id'] == first_word['id']:
-            prec_context = get_prec_context(idx, segments, segments_ids)
-            if idx == 0 or segments[segments_ids[idx - 1]]['lastinsent']:
-                first_in_sentence = True
-            if idx == 0 or segments[segments_ids[idx - 1]]['lastinpar']:
-                first_in_paragraph = True
-        if word['id'] == last_word['id']:
-            follow_context = get_follow_context(idx, segments, segments_ids)
-            sentence = get_sentence(idx, segments, segments_ids)
-            break
+    start = words_index.get_position(mention_words[0]['id'])
+    end = words_index.get_position(mention_words[-1]['id'])
+    # words are searched from the document start, a mention ending before its first word has no preceding context
+    if start <= end:
+        prec_context = words_index.get_prec_context(start)
+        first_in_sentence = words_index.is_first_in_sentence(start)
+        first_in_paragraph = words_index.is_first_in_paragraph(start)
+    follow_context = words_index.get_follow_context(end)
+    sentence = words_index.get_sentence(end)
     return (sentence, prec_context, follow_context, first_in_sentence, first_in_paragraph)
 
 
-def get_prec_context(mention_start, segments, segments_ids):
-    context = []
-    context_start = mention_start - 1
-    while context_start >= 0:
-        if not word_to_ignore(segments[segments_ids[context_start]]):
-            context.append(segments[segments_ids[context_start]])
-        if len(context) == conf.CONTEXT:
-            break
-        context_start -= 1
-    context.reverse()
-    return context
-
-
-def get_follow_context(mention_end, segments, segments_ids):
-    context = []
-    context_end = mention_end + 1
-    while context_end < len(segments):
-        if not word_to_ignore(segments[segments_ids[context_end]]):
-            context.append(segments[segments_ids[context_end]])
-        if len(context) == conf.CONTEXT:
-            break
-        context_end += 1
-    return context
-
-
-def get_sentence(word_idx, segments, segments_ids):
-    sentence_start = get_sentence_start(segments, segments_ids, word_idx)
-    sentence_end = get_sentence_end(segments, segments_ids, word_idx)
-    sentence = [segments[morph_id] for morph_id in segments_ids[sentence_start:sentence_end + 1]
-                if not word_to_ignore(segments[morph_id])]
-    return sentence
-
-
-def get_sentence_start(segments, segments_ids, word_idx):
-    search_start = word_idx
-    while word_idx >= 0:
-        if segments[segments_ids[word_idx]]['lastinsent'] and search_start != word_idx:
-            return word_idx + 1
-        word_idx -= 1
-    return 0
-
-
-def get_sentence_end(segments, segments_ids, word_idx):
-    while word_idx < len(segments):
-        if segments[segments_ids[word_idx]]['lastinsent']:
-            return word_idx
-        word_idx += 1
-    return len(segments) - 1
-
-
 def word_to_ignore(word):
     if word['ctag'] == 'interp':
         return True
@@ -373,16 +351,13 @@ def get_rarest_word(words):
 
 # coreference
 def add_coreference_layer(ann_archive, text):
-    ann_file = gzip.open(ann_archive, 'rb')
-    parser = etree.XMLParser(encoding="utf-8")
-    tree = etree.parse(ann_file, parser)
-    body = tree.xpath('//xmlns:body', namespaces={'xmlns': TEI_NS})[0]
-
-    parts = body.xpath(".//xmlns:p", namespaces={'xmlns': TEI_NS})
-    for par in parts:
-        coreferences = par.xpath(".//xmlns:seg", namespaces={'xmlns': TEI_NS})
-        for cor in coreferences:
-            add_coreference(cor, text)
+    par_depth = 0
+    for event, element in iterparse_body(ann_archive, ['p', 'seg']):
+        if element.tag == P_TAG:
+            par_depth += 1 if event == 'start' else -1
+        elif par_depth > 0 and event == 'end':
+            add_coreference(element, text)
+            clear_element(element)
 
 
 def add_coreference(coref, text):
@@ -390,22 +365,42 @@ def add_coreference(coref, text):
 
     coref_type = None
     dominant = None
-    for f in coref.xpath(".//xmlns:f", namespaces={'xmlns': TEI_NS}):
+    for f in coref.iter(F_TAG):
         if f.attrib['name'] == 'type':
             coref_type = get_fval(f)
         elif f.attrib['name'] == 'dominant':
             dominant = get_fval(f)
 
     if coref_type == 'ident':
-        for ptr in coref.xpath(".//xmlns:ptr", namespaces={'xmlns': TEI_NS}):
+        for ptr in coref.iter(PTR_TAG):
             mnt_id = ptr.attrib['target'].split('#')[-1]
             mention = text.get_mention(mnt_id)
             mention.set = idx
             mention.dominant = dominant
 
 
+# layers are streamed, elements which are not needed any more are cleared, so whole trees are not kept in memory
+def iterparse_body(ann_archive, tags):
+    tags = [BODY_TAG] + ['{%s}%s' % (TEI_NS, tag) for tag in tags]
+    in_body = False
+    with gzip.open(ann_archive, 'rb') as ann_file:
+        for event, element in etree.iterparse(ann_file, events=('start', 'end'), tag=tags, encoding='utf-8'):
+            if element.tag == BODY_TAG:
+                if event == 'end':
+                    return
+                in_body = True
+            elif in_body:
+                yield event, element
+
+
+def clear_element(element):
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
 # write
-def write(inpath, outpath, text):
+def write(inpath, outpath, text, link_layers=conf.LINK_LAYERS, gzip_level=conf.GZIP_LEVEL):
     if not os.path.exists(outpath):
         os.makedirs(outpath, exist_ok=True)
 
@@ -413,49 +408,60 @@ def write(inpath, outpath, text):
         if not filename.startswith('ann_coreference'):
             layer_inpath = os.path.join(inpath, filename)
             layer_outpath = os.path.join(outpath, filename)
-            copy_layer(layer_inpath, layer_outpath)
+            copy_layer(layer_inpath, layer_outpath, link_layers)
 
     coref_outpath = os.path.join(outpath, 'ann_coreference.xml.gz')
-    write_coreference(coref_outpath, text)
-
+    write_coreference(coref_outpath, text, gzip_level)
 
-def copy_layer(src, dest):
-    shutil.copyfile(src, dest)
 
+def copy_layer(src, dest, link=False):
+    copy_file(src, dest, link)
 
-def write_coreference(outpath, text):
-    root, tei = write_header()
-    write_body(tei, text)
 
-    with gzip.open(outpath, 'wb') as output_file:
-        output_file.write(etree.tostring(root, pretty_print=True,
-                                         xml_declaration=True, encoding='UTF-8'))
+# coreference layer is written incrementally, only one coreference set element is built at a time
+def write_coreference(outpath, text, gzip_level=conf.GZIP_LEVEL):
+    with gzip.open(outpath, 'wb', compresslevel=gzip_level) as output_file:
+        with etree.xmlfile(output_file, encoding='UTF-8') as xml_file:
+            xml_file.write_declaration()
+            with xml_file.element('teiCorpus', nsmap=NSMAP):
+                write_xinclude(xml_file, 'PCC_header.xml', 1)
+                with write_element(xml_file, 'TEI', 1):
+                    write_xinclude(xml_file, 'header.xml', 2)
+                    with write_element(xml_file, 'text', 2):
+                        with write_element(xml_file, 'body', 3):
+                            with write_element(xml_file, 'p', 4):
+                                write_body(xml_file, text, 5)
+                write_indent(xml_file, 0)
+        # text is not allowed outside of the root element by xmlfile
+        output_file.write(b'\n')
 
 
-def write_header():
-    root = etree.Element('teiCorpus', nsmap=NSMAP)
+@contextmanager
+def write_element(xml_file, tag, level, **kwargs):
+    write_indent(xml_file, level)
+    with xml_file.element(tag, **kwargs):
+        yield
+        write_indent(xml_file, level)
 
-    corpus_xinclude = etree.SubElement(root, etree.QName(XI_NS, 'include'))
-    corpus_xinclude.attrib['href'] = 'PCC_header.xml'
 
-    tei = etree.SubElement(root, 'TEI')
-    tei_xinclude = etree.SubElement(tei, etree.QName(XI_NS, 'include'))
-    tei_xinclude.attrib['href'] = 'header.xml'
+def write_indent(xml_file, level):
+    xml_file.write('\n' + INDENT * level)
 
-    return root, tei
 
+def write_xinclude(xml_file, href, level):
+    write_indent(xml_file, level)
+    with xml_file.element(etree.QName(XI_NS, 'include'), href=href):
+        pass
 
-def write_body(tei, text):
-    text_node = etree.SubElement(tei, 'text')
-    body = etree.SubElement(text_node, 'body')
-    p = etree.SubElement(body, 'p')
 
+def write_body(xml_file, text, level):
     sets = text.get_sets()
     for set_id in sets:
         comment_text = create_set_comment(sets[set_id])
-        p.append(etree.Comment(comment_text))
+        write_indent(xml_file, level)
+        xml_file.write(etree.Comment(comment_text))
 
-        seg = etree.SubElement(p, 'seg')
+        seg = etree.Element('seg')
         seg.attrib[etree.QName(XML_NS, 'id')] = set_id.replace('set', 'coreference')
 
         fs = etree.SubElement(seg, 'fs')
@@ -474,6 +480,10 @@ def write_body(tei, text):
             ptr = etree.SubElement(seg, 'ptr')
             ptr.attrib['target'] = 'ann_mentions.xml#%s' % mnt.id
 
+        etree.indent(seg, space=INDENT, level=level)
+        write_indent(xml_file, level)
+        xml_file.write(seg)
+
 
 def create_set_comment(mentions):
     mentions_orths = [mnt.text for mnt in mentions]
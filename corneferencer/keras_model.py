@@ -0,0 +1,98 @@
+from tensorflow.keras.models import Sequential, Model
+from tensorflow.keras.layers import Input, Dense, Dropout, Activation, BatchNormalization, Lambda
+from tensorflow.keras import backend as K
+
+from corneferencer import numpy_model
+
+
+def initialize_simple_model(number_of_features, path_to_model):
+    inputs = Input(shape=(number_of_features,))
+
+    output_from_1st_layer = Dense(1000)(inputs)
+    output_from_1st_layer = BatchNormalization()(output_from_1st_layer)
+    output_from_1st_layer = Activation('relu')(output_from_1st_layer)
+    output_from_1st_layer = Dropout(0.2)(output_from_1st_layer)
+
+    output_from_2nd_layer = Dense(500)(output_from_1st_layer)
+    output_from_2nd_layer = BatchNormalization()(output_from_2nd_layer)
+    output_from_2nd_layer = Activation('relu')(output_from_2nd_layer)
+    output_from_2nd_layer = Dropout(0.2)(output_from_2nd_layer)
+
+    output_from_3rd_layer = Dense(300)(output_from_2nd_layer)
+    output_from_3rd_layer = BatchNormalization()(output_from_3rd_layer)
+    output_from_3rd_layer = Activation('relu')(output_from_3rd_layer)
+    output_from_3rd_layer = Dropout(0.2)(output_from_3rd_layer)
+
+    output = Dense(1, activation='sigmoid')(output_from_3rd_layer)
+
+    model = Model(inputs, output)
+    model.compile(optimizer='Adam', loss='binary_crossentropy', metrics=['accuracy'])
+    print(path_to_model)
+    model.load_weights(path_to_model)
+
+    return model
+
+
+# splits the first (linear) dense layer off the simple model, the rest of the network
+# is run on activations summed from per mention projections and the pair block
+def factorize_simple_model(model):
+    first_layer = model.layers[1]
+    kernel, bias = first_layer.get_weights()
+
+    tail_inputs = Input(shape=(kernel.shape[1],))
+    tail_output = tail_inputs
+    for layer in model.layers[2:]:
+        tail_output = layer(tail_output)
+    tail = Model(tail_inputs, tail_output)
+
+    return numpy_model.FactorizedModel(kernel, bias, tail)
+
+
+def initialize_siamese_model(number_of_features, path_to_model):
+    input_dim = number_of_features
+
+    base_network = create_base_network(input_dim)
+
+    input_a = Input(shape=(input_dim,))
+    input_b = Input(shape=(input_dim,))
+
+    processed_a = base_network(input_a)
+    processed_b = base_network(input_b)
+
+    distance = Lambda(euclidean_distance, output_shape=eucl_dist_output_shape)([processed_a, processed_b])
+
+    model = Model([input_a, input_b], distance)
+    model.compile(loss=contrastive_loss, optimizer='Adam')
+    model.load_weights(path_to_model)
+
+    return model
+
+
+def create_base_network(input_dim):
+    seq = Sequential()
+
+    seq.add(Dense(1000, input_shape=(input_dim,), activation='relu'))
+    seq.add(Dropout(0.2))
+    seq.add(BatchNormalization())
+
+    seq.add(Dense(500, activation='relu'))
+    seq.add(Dropout(0.2))
+    seq.add(BatchNormalization())
+
+    seq.add(Dense(300, activation='relu'))
+    return seq
+
+
+def euclidean_distance(vects):
+    x, y = vects
+    return K.sqrt(K.maximum(K.sum(K.square(x - y), axis=1, keepdims=True), K.epsilon()))
+
+
+def eucl_dist_output_shape(shapes):
+    shape1, shape2 = shapes
+    return shape1[0], 1
+
+
+def contrastive_loss(y_true, y_pred):
+    margin = 1
+    return K.mean(y_true * K.square(y_pred) + (1 - y_true) * K.square(K.maximum(margin - y_pred, 0)))
@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import sys
 import timeit
@@ -14,7 +15,7 @@ import conf
 import utils
 from inout import mmax, tei
 from inout.constants import INPUT_FORMATS
-from resolvers import resolve
+from resolvers import resolve, scoring
 from resolvers.constants import RESOLVERS
 from utils import eprint
 
@@ -23,17 +24,37 @@ def main():
     args = parse_arguments()
     if not args.input:
         eprint("Error: Input file(s) not specified!")
-    elif args.resolver not in RESOLVERS:
+    elif not get_resolvers(args.resolver) or not all(resolver in RESOLVERS
+                                                     for resolver in get_resolvers(args.resolver)):
         eprint("Error: Unknown resolve algorithm!")
     elif args.format not in INPUT_FORMATS:
         eprint("Error: Unknown input file format!")
+    elif args.backend not in utils.NEURAL_MODEL_BACKENDS:
+        eprint("Error: Unknown neural model backend!")
+    elif args.batch_size < 1:
+        eprint("Error: Batch size must be positive!")
+    elif args.workers < 1:
+        eprint("Error: Number of workers must be positive!")
+    elif args.max_tasks_per_child < 0:
+        eprint("Error: Number of texts processed by a worker must not be negative!")
+    elif not 0 <= args.gzip_level <= 9:
+        eprint("Error: Gzip level must be between 0 and 9!")
+    elif args.thresholds and not utils.parse_thresholds(args.thresholds):
+        eprint("Error: Thresholds must be given as start:stop:step!")
+    elif min(args.max_mention_distance, args.max_sentence_distance, args.max_paragraph_distance) < 0:
+        eprint("Error: Candidates window distances must not be negative!")
     else:
-        resolver = args.resolver
+        resolvers = get_resolvers(args.resolver)
         if conf.NEURAL_MODEL_ARCHITECTURE == 'siamese':
-            resolver = conf.NEURAL_MODEL_ARCHITECTURE
+            resolvers = [conf.NEURAL_MODEL_ARCHITECTURE]
             eprint("Warning: Using %s resolver because of selected neural model architecture!" %
                    conf.NEURAL_MODEL_ARCHITECTURE)
-        process_texts(args.input, args.output, args.format, resolver, args.threshold, args.model)
+        model_path = args.model or conf.NEURAL_MODEL_PATH
+        process_texts(args.input, args.output, args.format, resolvers, args.threshold, model_path,
+                      args.batch_size, args.factorized, args.backend, args.workers, args.max_tasks_per_child,
+                      args.link_layers, args.gzip_level, utils.parse_thresholds(args.thresholds), args.scores_cache,
+                      scoring.get_window(args.max_mention_distance, args.max_sentence_distance,
+                                         args.max_paragraph_distance, args.keep_matching))
 
 
 def parse_arguments():
@@ -53,89 +74,234 @@ def parse_arguments():
                         help='output path; if not specified writes output to standard output')
     parser.add_argument('-r', '--resolver', type=str, action='store',
                         dest='resolver', default=RESOLVERS[0],
-                        help='resolve algorithm; default: %s; possibilities: %s'
+                        help='resolve algorithm or comma separated algorithms (e.g. all2all,closest,incremental), '
+                             'which share mention pairs scores and write output to directories named after them; '
+                             'default: %s; possibilities: %s'
                              % (RESOLVERS[0], ', '.join(RESOLVERS)))
     parser.add_argument('-t', '--threshold', type=float, action='store',
                         dest='threshold', default=0.85,
                         help='threshold; default: 0.85')
+    parser.add_argument('--thresholds', type=str, action='store',
+                        dest='thresholds', default='',
+                        help='thresholds sweep as start:stop:step (e.g. 0.5:0.95:0.05), mention pairs are scored '
+                             'once and output for each threshold is written to threshold_<value> directory')
+    parser.add_argument('--scores-cache', type=str, action='store',
+                        dest='scores_cache', default=conf.SCORES_CACHE_PATH,
+                        help='directory of cached mention pairs scores (one npz file per text), cached scores '
+                             'are used only for the same model and the same text; default: no cache')
+    parser.add_argument('--max-mention-distance', type=int, action='store',
+                        dest='max_mention_distance', default=conf.MAX_MENTION_DISTANCE,
+                        help='maximal distance in mentions between antecedent and anaphora candidates, '
+                             '0 means no limit; default: %d' % conf.MAX_MENTION_DISTANCE)
+    parser.add_argument('--max-sentence-distance', type=int, action='store',
+                        dest='max_sentence_distance', default=conf.MAX_SENTENCE_DISTANCE,
+                        help='maximal distance in sentences between antecedent and anaphora candidates, '
+                             '0 means no limit; default: %d' % conf.MAX_SENTENCE_DISTANCE)
+    parser.add_argument('--max-paragraph-distance', type=int, action='store',
+                        dest='max_paragraph_distance', default=conf.MAX_PARAGRAPH_DISTANCE,
+                        help='maximal distance in paragraphs between antecedent and anaphora candidates, '
+                             '0 means no limit; default: %d' % conf.MAX_PARAGRAPH_DISTANCE)
+    parser.add_argument('--prune-matching', action='store_false',
+                        dest='keep_matching', default=conf.KEEP_MATCHING_CANDIDATES,
+                        help='apply distance limits also to candidates with the same text or head as the anaphora')
+    parser.add_argument('-b', '--batch-size', type=int, action='store',
+                        dest='batch_size', default=conf.BATCH_SIZE,
+                        help='number of mention pairs scored at once; default: %d' % conf.BATCH_SIZE)
+    parser.add_argument('--factorized', action='store_true',
+                        dest='factorized', default=conf.FACTORIZED_INFERENCE,
+                        help='compute first layer projections once per mention (simple architecture only)')
+    parser.add_argument('--backend', type=str, action='store',
+                        dest='backend', default=conf.NEURAL_MODEL_BACKEND,
+                        help='neural model backend; default: %s; possibilities: %s'
+                             % (conf.NEURAL_MODEL_BACKEND, ', '.join(utils.NEURAL_MODEL_BACKENDS)))
+    parser.add_argument('-w', '--workers', type=int, action='store',
+                        dest='workers', default=conf.WORKERS,
+                        help='number of worker processes used for input dir; default: %d' % conf.WORKERS)
+    parser.add_argument('--max-tasks-per-child', type=int, action='store',
+                        dest='max_tasks_per_child', default=conf.MAX_TASKS_PER_CHILD,
+                        help='texts processed by a worker before it is replaced, 0 means never; default: %d'
+                             % conf.MAX_TASKS_PER_CHILD)
+    parser.add_argument('--link-layers', action='store_true',
+                        dest='link_layers', default=conf.LINK_LAYERS,
+                        help='hardlink (or symlink) unchanged layers to the input instead of copying them')
+    parser.add_argument('--gzip-level', type=int, action='store',
+                        dest='gzip_level', default=conf.GZIP_LEVEL,
+                        help='compression level of written gzipped layers; default: %d' % conf.GZIP_LEVEL)
 
     args = parser.parse_args()
     return args
 
 
-def process_texts(inpath, outpath, informat, resolver, threshold, model_path):
+def get_resolvers(resolvers):
+    return [resolver.strip() for resolver in resolvers.split(',') if resolver.strip()]
+
+
+def process_texts(inpath, outpath, informat, resolvers, threshold, model_path, batch_size, factorized, backend,
+                  workers, max_tasks_per_child, link_layers, gzip_level, thresholds, scores_cache, window):
     if os.path.isdir(inpath):
-        process_directory(inpath, outpath, informat, resolver, threshold, model_path)
+        process_directory(inpath, outpath, informat, resolvers, threshold, model_path, batch_size, factorized,
+                          backend, workers, max_tasks_per_child, link_layers, gzip_level, thresholds, scores_cache,
+                          window)
     elif os.path.isfile(inpath):
-        process_text(inpath, outpath, informat, resolver, threshold, model_path)
+        model = utils.get_neural_model(conf.NEURAL_MODEL_ARCHITECTURE, conf.NUMBER_OF_FEATURES, model_path,
+                                       factorized, backend)
+        process_text(inpath, outpath, informat, resolvers, threshold, model, batch_size, link_layers, gzip_level,
+                     thresholds, scores_cache, window)
     else:
         eprint("Error: Specified input does not exist!")
 
-def one_text(filename, model, inpath, outpath, resolver='all2all', informat='tei', treshold=0.85):
+def one_text(filename, model, inpath, outpath, resolvers=('all2all',), informat='tei', treshold=0.85,
+             batch_size=conf.BATCH_SIZE, factorized=conf.FACTORIZED_INFERENCE, backend=conf.NEURAL_MODEL_BACKEND,
+             link_layers=conf.LINK_LAYERS, gzip_level=conf.GZIP_LEVEL, thresholds=None,
+             scores_cache=conf.SCORES_CACHE_PATH, window=None):
     textname = os.path.splitext(os.path.basename(filename))[0]
     textoutput = os.path.join(outpath, textname)
     textinput = os.path.join(inpath, filename)
     print(textinput)
-    model = utils.initialize_neural_model(conf.NEURAL_MODEL_ARCHITECTURE, conf.NUMBER_OF_FEATURES, model)
+    model = utils.get_neural_model(conf.NEURAL_MODEL_ARCHITECTURE, conf.NUMBER_OF_FEATURES, model,
+                                   factorized, backend)
     try:
-        process_text(textinput, textoutput, informat, resolver, treshold, model)
+        process_text(textinput, textoutput, informat, resolvers, treshold, model, batch_size, link_layers, gzip_level,
+                     thresholds, scores_cache, window)
     except Exception as e:
         print(textinput)
         print(e)
         traceback.print_exc()
 
-def process_directory(inpath, outpath, informat, resolver, threshold, model):
+# error of worker initialization, reported by worker tasks instead of processing texts
+WORKER_ERROR = None
+
+
+def one_text_task(task):
+    if WORKER_ERROR is not None:
+        return WORKER_ERROR
+    one_text(*task)
+    return None
+
+
+# runs once in every worker process, so texts do not pay for resources and model loading;
+# failures are not raised, pool would replace failing workers endlessly
+def init_worker(model_path, factorized, backend):
+    global WORKER_ERROR
+    try:
+        conf.preload()
+        utils.get_neural_model(conf.NEURAL_MODEL_ARCHITECTURE, conf.NUMBER_OF_FEATURES, model_path,
+                               factorized, backend)
+    except Exception as e:
+        WORKER_ERROR = '%s: %s' % (type(e).__name__, e)
+
+
+def process_directory(inpath, outpath, informat, resolvers, threshold, model, batch_size, factorized, backend,
+                      workers=conf.WORKERS, max_tasks_per_child=conf.MAX_TASKS_PER_CHILD,
+                      link_layers=conf.LINK_LAYERS, gzip_level=conf.GZIP_LEVEL, thresholds=None,
+                      scores_cache=conf.SCORES_CACHE_PATH, window=None):
     inpath = os.path.abspath(inpath)
     outpath = os.path.abspath(outpath)
 
     files = os.listdir(inpath)
     files = natsorted(files)
 
-    # for filename in files:
-    import multiprocessing
-    from itertools import repeat
-    pool_obj = multiprocessing.Pool(processes=1)
-#    answer = pool_obj.starmap(
-#        one_text, zip(files, repeat(model), repeat(inpath),
-#            repeat(outpath), repeat(resolver), repeat(informat),
-#            repeat(threshold))
-#        )
-    for p in tqdm(files):
-        one_text(p, model, inpath, outpath, resolver, informat, threshold)
+    if workers > 1:
+        # largest texts first, so that no worker gets a huge text at the end of the run
+        files = sorted(files, key=lambda filename: get_text_size(inpath, filename, informat), reverse=True)
+        tasks = [(filename, model, inpath, outpath, resolvers, informat, threshold, batch_size, factorized, backend,
+                  link_layers, gzip_level, thresholds, scores_cache, window)
+                 for filename in files]
+        # spawn instead of fork, tensorflow state is not fork safe
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes=workers, initializer=init_worker, initargs=(model, factorized, backend),
+                          maxtasksperchild=max_tasks_per_child or None) as pool:
+            for error in tqdm(pool.imap_unordered(one_text_task, tasks), total=len(tasks)):
+                if error is not None:
+                    eprint("Error: Worker initialization failed (%s)!" % error)
+                    pool.terminate()
+                    break
+    else:
+        for p in tqdm(files):
+            one_text(p, model, inpath, outpath, resolvers, informat, threshold, batch_size, factorized, backend,
+                     link_layers, gzip_level, thresholds, scores_cache, window)
+
+
+def get_text_size(inpath, filename, informat):
+    textpath = os.path.join(inpath, filename)
+    if informat == 'tei':
+        textpath = os.path.join(textpath, 'ann_mentions.xml.gz')
+    elif informat == 'mmax' and filename.endswith('.mmax'):
+        textname = os.path.splitext(filename)[0]
+        textpath = os.path.join(inpath, '%s_words.xml' % textname)
+    if os.path.isfile(textpath):
+        return os.path.getsize(textpath)
+    return 0
 
 
-def process_text(inpath, outpath, informat, resolver, threshold, model):
+# resolvers share mention pairs scores of the text, each of them starts from the input sets
+def process_text(inpath, outpath, informat, resolvers, threshold, model, batch_size,
+                 link_layers=conf.LINK_LAYERS, gzip_level=conf.GZIP_LEVEL, thresholds=None,
+                 scores_cache=conf.SCORES_CACHE_PATH, window=None):
     basename = os.path.basename(inpath)
     if informat == 'mmax' and basename.endswith('.mmax'):
         print (basename)
         text = mmax.read(inpath)
-        if resolver == 'incremental':
-            resolve.incremental(text, threshold, model)
-        elif resolver == 'entity_based':
-            resolve.entity_based(text, threshold, model)
-        elif resolver == 'closest':
-            resolve.closest(text, threshold, model)
-        elif resolver == 'siamese':
-            resolve.siamese(text, threshold, model)
-        elif resolver == 'all2all':
-            resolve.all2all(text, threshold, model)
-        mmax.write(inpath, outpath, text)
     elif informat == 'tei':
-        #print (basename)
         text = tei.read(inpath)
-        #print(text)
-        # print(text.get_sets())
-        if resolver == 'incremental':
-            resolve.incremental(text, threshold, model)
-        elif resolver == 'entity_based':
-            resolve.entity_based(text, threshold, model)
-        elif resolver == 'closest':
-            resolve.closest(text, threshold, model)
-        elif resolver == 'siamese':
-            resolve.siamese(text, threshold, model)
-        elif resolver == 'all2all':
-            resolve.all2all(text, threshold, model)
-        tei.write(inpath, outpath, text)
+    else:
+        return
+
+    if window is None:
+        window = scoring.get_window()
+    input_sets = text.get_mentions_sets()
+    scores = {}
+    for resolver in resolvers:
+        siamese = resolve.uses_siamese_scores(resolver)
+        if siamese not in scores:
+            start_time = timeit.default_timer()
+            scores[siamese] = get_scores(inpath, text, siamese, model, batch_size, scores_cache, window)
+            print('%s scoring time: %.2f s' % (basename, timeit.default_timer() - start_time))
+            if window.is_limited():
+                print('%s pruned pairs: %d' % (basename, scoring.count_pruned_pairs(text.mentions, scores[siamese][1])))
+
+        resolver_outpath = outpath
+        if len(resolvers) > 1:
+            resolver_outpath = get_run_outpath(outpath, resolver)
+
+        resolve_time = 0.0
+        for run_threshold in thresholds or [threshold]:
+            text.set_mentions_sets(input_sets)
+            start_time = timeit.default_timer()
+            resolve.resolve(text, resolver, run_threshold, model, batch_size, scores[siamese])
+            resolve_time += timeit.default_timer() - start_time
+
+            run_outpath = resolver_outpath
+            if thresholds:
+                run_outpath = get_run_outpath(resolver_outpath, 'threshold_%g' % run_threshold)
+            write_text(inpath, run_outpath, informat, text, link_layers, gzip_level)
+        print('%s %s time: %.2f s' % (basename, resolver, resolve_time))
+
+
+def get_scores(inpath, text, siamese, model, batch_size, scores_cache, window):
+    if not scores_cache:
+        return scoring.score_matrix(text.mentions, model, batch_size, siamese, window)
+    os.makedirs(scores_cache, exist_ok=True)
+    textname = os.path.splitext(os.path.basename(os.path.normpath(inpath)))[0]
+    if siamese:
+        textname = '%s_siamese' % textname
+    cache_path = os.path.join(scores_cache, '%s.npz' % textname)
+    return scoring.cached_score_matrix(text.mentions, model, utils.get_neural_model_key(model), batch_size,
+                                       cache_path, siamese, window)
+
+
+def write_text(inpath, outpath, informat, text, link_layers=conf.LINK_LAYERS, gzip_level=conf.GZIP_LEVEL):
+    if informat == 'mmax':
+        os.makedirs(os.path.dirname(os.path.abspath(outpath)), exist_ok=True)
+        mmax.write(inpath, outpath, text, link_layers)
+    elif informat == 'tei':
+        tei.write(inpath, outpath, text, link_layers, gzip_level)
+
+
+# text output path inside run directory (resolver name or threshold_<value>), next to the text output path
+def get_run_outpath(outpath, run_dir):
+    outpath = os.path.normpath(outpath)
+    return os.path.join(os.path.dirname(outpath), run_dir, os.path.basename(outpath))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,158 @@
+import h5py
+import numpy
+
+
+# keras defaults used by the trained models
+BATCH_NORM_EPSILON = 1e-3
+EUCLIDEAN_EPSILON = 1e-7
+
+
+def initialize_simple_model(number_of_features, path_to_model):
+    layers = read_weights(path_to_model)
+    check_number_of_features(layers, number_of_features, path_to_model)
+
+    # dense -> batch normalization -> relu -> dropout, batch normalization is folded into the dense layer
+    dense_layers = []
+    for layer in layers:
+        if 'kernel' in layer:
+            dense_layers.append([layer['kernel'], layer['bias'], 'relu'])
+        else:
+            dense_layers[-1][:2] = fold_batch_norm(dense_layers[-1][0], dense_layers[-1][1], layer)
+    dense_layers[-1][2] = 'sigmoid'
+
+    return NumpyModel(dense_layers)
+
+
+def initialize_siamese_model(number_of_features, path_to_model):
+    layers = read_weights(path_to_model)
+    check_number_of_features(layers, number_of_features, path_to_model)
+
+    # dense with relu -> dropout -> batch normalization, batch normalization is folded into the next dense layer
+    dense_layers = []
+    batch_norm = None
+    for layer in layers:
+        if 'kernel' in layer:
+            kernel, bias = layer['kernel'], layer['bias']
+            if batch_norm is not None:
+                kernel, bias = fold_batch_norm_into_next(batch_norm, kernel, bias)
+                batch_norm = None
+            dense_layers.append([kernel, bias, 'relu'])
+        else:
+            batch_norm = layer
+
+    return NumpySiameseModel(NumpyModel(dense_layers))
+
+
+def factorize_simple_model(model):
+    kernel, bias, activation = model.layers[0]
+    tail = NumpyModel(model.layers[1:], input_activation=activation)
+    return FactorizedModel(kernel, bias, tail)
+
+
+def check_number_of_features(layers, number_of_features, path_to_model):
+    input_size = layers[0]['kernel'].shape[0]
+    if input_size != number_of_features:
+        raise ValueError('Model %s expects %d features, not %d!' % (path_to_model, input_size, number_of_features))
+
+
+# returns weights of consecutive layers as dicts, e.g. {'kernel': ..., 'bias': ...};
+# nested models (siamese base network) list non-trainable weights after all trainable ones
+def read_weights(path_to_model):
+    layers = []
+    with h5py.File(path_to_model, 'r') as model_file:
+        weights_group = model_file
+        if 'model_weights' in model_file:
+            weights_group = model_file['model_weights']
+        for layer_name in weights_group.attrs['layer_names']:
+            layer_group = weights_group[to_str(layer_name)]
+            group_layers = {}
+            for weight_name in layer_group.attrs['weight_names']:
+                weight_name = to_str(weight_name)
+                layer_path, variable = weight_name.rsplit('/', 1)
+                if layer_path not in group_layers:
+                    group_layers[layer_path] = {}
+                    layers.append(group_layers[layer_path])
+                weight = numpy.asarray(layer_group[weight_name], dtype=numpy.float32)
+                group_layers[layer_path][variable.split(':')[0]] = weight
+    return layers
+
+
+def to_str(name):
+    if isinstance(name, bytes):
+        return name.decode('utf-8')
+    return name
+
+
+def get_batch_norm_scale_and_shift(batch_norm):
+    scale = batch_norm['gamma'] / numpy.sqrt(batch_norm['moving_variance'] + BATCH_NORM_EPSILON)
+    shift = batch_norm['beta'] - batch_norm['moving_mean'] * scale
+    return scale, shift
+
+
+# batch normalization applied directly to the dense layer output
+def fold_batch_norm(kernel, bias, batch_norm):
+    scale, shift = get_batch_norm_scale_and_shift(batch_norm)
+    return kernel * scale, bias * scale + shift
+
+
+# batch normalization applied to the next dense layer input
+def fold_batch_norm_into_next(batch_norm, kernel, bias):
+    scale, shift = get_batch_norm_scale_and_shift(batch_norm)
+    return kernel * scale[:, numpy.newaxis], bias + shift.dot(kernel)
+
+
+def activate(values, activation):
+    if activation == 'relu':
+        return numpy.maximum(values, 0.0)
+    elif activation == 'sigmoid':
+        return 1.0 / (1.0 + numpy.exp(-values))
+    return values
+
+
+class NumpyModel:
+
+    def __init__(self, layers, input_activation=None):
+        self.layers = [(numpy.asarray(kernel, dtype=numpy.float32), numpy.asarray(bias, dtype=numpy.float32),
+                        activation) for kernel, bias, activation in layers]
+        self.input_activation = input_activation
+
+    def predict(self, samples, batch_size=None, verbose=0):
+        values = activate(numpy.asarray(samples, dtype=numpy.float32), self.input_activation)
+        for kernel, bias, activation in self.layers:
+            values = activate(values.dot(kernel) + bias, activation)
+        return values
+
+
+class NumpySiameseModel:
+
+    def __init__(self, base_network):
+        self.base_network = base_network
+
+    def predict(self, samples, batch_size=None, verbose=0):
+        processed_a = self.base_network.predict(samples[0])
+        processed_b = self.base_network.predict(samples[1])
+        squared_distance = numpy.sum(numpy.square(processed_a - processed_b), axis=1, keepdims=True)
+        return numpy.sqrt(numpy.maximum(squared_distance, EUCLIDEAN_EPSILON))
+
+
+class FactorizedModel:
+
+    def __init__(self, kernel, bias, tail):
+        self.kernel = numpy.asarray(kernel, dtype=numpy.float32)
+        self.bias = numpy.asarray(bias, dtype=numpy.float32)
+        self.tail = tail
+
+    def project_mentions(self, mentions_features):
+        features_count = mentions_features.shape[1]
+        ante_projections = mentions_features.dot(self.kernel[:features_count])
+        ana_projections = mentions_features.dot(self.kernel[features_count:2 * features_count])
+        return ante_projections, ana_projections
+
+    def predict_pairs(self, ante_projections, ana_projections, pairs_features, batch_size=None):
+        pair_kernel = self.kernel[self.kernel.shape[0] - pairs_features.shape[1]:]
+        activations = ante_projections + ana_projections + pairs_features.dot(pair_kernel) + self.bias
+        return self.tail.predict(activations, batch_size=batch_size, verbose=0)
+
+    def predict(self, samples, batch_size=None, verbose=0):
+        activations = samples.dot(self.kernel) + self.bias
+        return self.tail.predict(activations, batch_size=batch_size, verbose=verbose)
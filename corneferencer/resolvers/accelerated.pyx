@@ -0,0 +1,54 @@
+# cython: language_level=3
+# compiled version of the subsequence string kernel from features.py, which is replaced by it if this module is built
+# (python corneferencer/build_accelerators.py); results are the same as of the pure python version
+cimport cython
+import numpy
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sk(str s1, str s2):
+    cdef double lam = 0.4
+    cdef Py_ssize_t h = len(s1) + 1
+    cdef Py_ssize_t w = len(s2) + 1
+    cdef Py_ssize_t p = min(len(s1), len(s2))
+    cdef Py_ssize_t i, j, m
+    cdef double k = 0.0
+    cdef double level = 0.0
+    cdef bint nonzero
+
+    if p == 0:
+        return 0.0
+
+    cdef const unsigned int[::1] chars1 = numpy.frombuffer(s1.encode('utf-32-le'), dtype=numpy.uint32)
+    cdef const unsigned int[::1] chars2 = numpy.frombuffer(s2.encode('utf-32-le'), dtype=numpy.uint32)
+    cdef double[:, ::1] dps = numpy.zeros((h, w), dtype=numpy.float64)
+    cdef double[:, ::1] dp = numpy.zeros((h, w), dtype=numpy.float64)
+
+    for i in range(1, h):
+        for j in range(1, w):
+            if chars1[i - 1] == chars2[j - 1]:
+                dps[i, j] = lam * lam
+                level += dps[i, j]
+    k += level
+
+    # levels with no common subsequence are not computed, since all the following ones are zero too
+    for m in range(1, p):
+        level = 0.0
+        nonzero = False
+        for j in range(w):
+            dp[m - 1, j] = 0.0
+        for i in range(h):
+            dp[i, m - 1] = 0.0
+
+        for i in range(m, h):
+            for j in range(m, w):
+                dp[i, j] = dps[i, j] + lam * dp[i - 1, j] + lam * dp[i, j - 1] - lam * lam * dp[i - 1, j - 1]
+                if chars1[i - 1] == chars2[j - 1]:
+                    dps[i, j] = lam * lam * dp[i - 1, j - 1]
+                    level += dps[i, j]
+                    nonzero = nonzero or dps[i, j] != 0.0
+        if not nonzero:
+            break
+        k += level
+    return k
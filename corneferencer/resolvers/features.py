@@ -1,3 +1,4 @@
+import hashlib
 import math
 import numpy
 import random
@@ -7,6 +8,12 @@ import conf
 from corneferencer.resolvers import constants
 
 
+OOV_VECTORS_CACHE = {}
+SELF_KERNELS_CACHE = {}
+KERNELS_CACHE = {}
+KERNELS_CACHE_SIZE = 1000000
+
+
 # mention features
 def head_vec(mention):
     head_base = mention.head_orth
@@ -56,19 +63,19 @@ def second_before_vec(mention):
 
 
 def preceding_context_vec(mention):
-    return list(get_context_vec(mention.prec_context, conf.W2V_MODEL))
+    return list(get_context_vec(mention.prec_context, conf.W2V_MODEL, mention.tokens_vectors))
 
 
 def following_context_vec(mention):
-    return list(get_context_vec(mention.follow_context, conf.W2V_MODEL))
+    return list(get_context_vec(mention.follow_context, conf.W2V_MODEL, mention.tokens_vectors))
 
 
 def mention_vec(mention):
-    return list(get_context_vec(mention.words, conf.W2V_MODEL))
+    return list(get_context_vec(mention.words, conf.W2V_MODEL, mention.tokens_vectors))
 
 
 def sentence_vec(mention):
-    return list(get_context_vec(mention.sentence, conf.W2V_MODEL))
+    return list(get_context_vec(mention.sentence, conf.W2V_MODEL, mention.tokens_vectors))
 
 
 def mention_type(mention):
@@ -193,36 +200,45 @@ def distances_vec(ante, ana):
 
 
 def pair_intersect(ante, ana):
-    for ante_word in ante.words:
-        for ana_word in ana.words:
-            if ana_word['id'] == ante_word['id']:
-                return 1.0
+    if not ante.words_ids.isdisjoint(ana.words_ids):
+        return 1.0
     return 0.0
 
 
+# mentions_count x mentions_count matrix, True where mentions share a word (same as pair_intersect)
+def overlap_matrix(mentions):
+    mentions_by_word = {}
+    for position, mnt in enumerate(mentions):
+        for word_id in mnt.words_ids:
+            mentions_by_word.setdefault(word_id, []).append(position)
+
+    overlaps = numpy.zeros((len(mentions), len(mentions)), dtype=bool)
+    for positions in mentions_by_word.values():
+        overlaps[numpy.ix_(positions, positions)] = True
+    return overlaps
+
+
 def head_match(ante, ana):
-    if ante.head_orth.lower() == ana.head_orth.lower():
+    if ante.lower_head_orth == ana.lower_head_orth:
         return 1.0
     return 0.0
 
 
 def exact_match(ante, ana):
-    if ante.text.lower() == ana.text.lower():
+    if ante.lower_text == ana.lower_text:
         return 1.0
     return 0.0
 
 
 def base_match(ante, ana):
-    if ante.lemmatized_text.lower() == ana.lemmatized_text.lower():
+    if ante.lower_lemmatized_text == ana.lower_lemmatized_text:
         return 1.0
     return 0.0
 
 
 def ante_contains_rarest_from_ana(ante, ana):
-    ana_rarest = ana.rarest
-    for word in ante.words:
-        if word['base'] == ana_rarest['base']:
-            return 1.0
+    if ana.rarest['base'] in ante.words_bases:
+        return 1.0
     return 0.0
 
 
@@ -239,10 +255,10 @@ def agreement(ante, ana, tag_name):
 
 
 def is_acronym(ante, ana):
-    if ana.text.upper() == ana.text:
-        return check_one_way_acronym(ana.text, ante.text)
-    if ante.text.upper() == ante.text:
-        return check_one_way_acronym(ante.text, ana.text)
+    if ana.is_upper:
+        return check_initials(ana.text, ante)
+    if ante.is_upper:
+        return check_initials(ante.text, ana)
     return 0.0
 
 
@@ -290,37 +306,31 @@ def flat_gender_agreement(ante, ana):
 
 
 def left_match(ante, ana):
-    if (ante.text.lower().startswith(ana.text.lower()) or
-            ana.text.lower().startswith(ante.text.lower())):
+    if (ante.lower_text.startswith(ana.lower_text) or
+            ana.lower_text.startswith(ante.lower_text)):
         return 1.0
     return 0.0
 
 
 def right_match(ante, ana):
-    if (ante.text.lower().endswith(ana.text.lower()) or
-            ana.text.lower().endswith(ante.text.lower())):
+    if (ante.lower_text.endswith(ana.lower_text) or
+            ana.lower_text.endswith(ante.lower_text)):
         return 1.0
     return 0.0
 
 
 def abbrev2(ante, ana):
-    ante_abbrev = get_abbrev(ante)
-    ana_abbrev = get_abbrev(ana)
-    if ante.head_orth == ana_abbrev or ana.head_orth == ante_abbrev:
+    if ante.head_orth == ana.abbrev or ana.head_orth == ante.abbrev:
         return 1.0
     return 0.0
 
 
 def string_kernel(ante, ana):
-    s1 = ante.text
-    s2 = ana.text
-    return sk(s1, s2) / (math.sqrt(sk(s1, s1) * sk(s2, s2)))
+    return normalized_kernel(ante.text, ana.text)
 
 
 def head_string_kernel(ante, ana):
-    s1 = ante.head_orth
-    s2 = ana.head_orth
-    return sk(s1, s2) / (math.sqrt(sk(s1, s1) * sk(s2, s2)))
+    return normalized_kernel(ante.head_orth, ana.head_orth)
 
 
 def wordnet_synonyms(ante, ana):
@@ -381,8 +391,8 @@ def wordnet_ante_is_hypernym(ante, ana):
 
 
 def wikipedia_link(ante, ana):
-    ante_base = ante.lemmatized_text.lower()
-    ana_base = ana.lemmatized_text.lower()
+    ante_base = ante.lower_lemmatized_text
+    ana_base = ana.lower_lemmatized_text
     if ante_base == ana_base:
         return 1.0
 
@@ -401,8 +411,8 @@ def wikipedia_link(ante, ana):
 
 
 def wikipedia_mutual_link(ante, ana):
-    ante_base = ante.lemmatized_text.lower()
-    ana_base = ana.lemmatized_text.lower()
+    ante_base = ante.lower_lemmatized_text
+    ana_base = ana.lower_lemmatized_text
     if ante_base == ana_base:
         return 1.0
 
@@ -421,8 +431,8 @@ def wikipedia_mutual_link(ante, ana):
 
 
 def wikipedia_redirect(ante, ana):
-    ante_base = ante.lemmatized_text.lower()
-    ana_base = ana.lemmatized_text.lower()
+    ante_base = ante.lower_lemmatized_text
+    ana_base = ana.lower_lemmatized_text
     if ante_base == ana_base:
         return 1.0
 
@@ -465,23 +475,43 @@ def adjsent_anapron_adjmen(ante, ana):
 
 # supporting functions
 def get_wv(model, lemma, use_random_vec=True):
-    vec = None
-    if use_random_vec:
-        vec = random_vec()
     try:
-        vec = model.wv[lemma]
+        return model.wv[lemma]
     except KeyError:
         pass
     except TypeError:
         pass
-    return vec
+    if use_random_vec:
+        return oov_vec(lemma)
+    return None
+
+
+def oov_vec(lemma):
+    if conf.OOV_VECTORS == 'random':
+        return random_vec()
+    if lemma not in OOV_VECTORS_CACHE:
+        vec = hash_vec(lemma)
+        vec.setflags(write=False)
+        OOV_VECTORS_CACHE[lemma] = vec
+    return OOV_VECTORS_CACHE[lemma]
 
 
 def random_vec():
     return numpy.asarray([random.uniform(-0.25, 0.25) for i in range(0, conf.W2V_SIZE)], dtype=numpy.float32)
 
 
-def get_context_vec(words, model):
+# same distribution as random_vec, but seeded with the lemma hash, so vectors are equal between runs and processes
+def hash_vec(lemma):
+    seed = int.from_bytes(hashlib.md5(str(lemma).encode('utf-8')).digest()[:4], 'little')
+    return numpy.random.RandomState(seed).uniform(-0.25, 0.25, conf.W2V_SIZE).astype(numpy.float32)
+
+
+def get_context_vec(words, model, tokens_vectors=None):
+    if tokens_vectors is not None:
+        span = tokens_vectors.get_span(words)
+        if span is not None:
+            return tokens_vectors.get_context_vec(words, *span)
+
     vec = numpy.zeros(conf.W2V_SIZE, dtype=numpy.float32)
     unknown_count = 0
     if len(words) != 0:
@@ -495,10 +525,69 @@ def get_context_vec(words, model):
         if significant_words != 0:
             vec = vec / float(significant_words)
         else:
-            vec = random_vec()
+            vec = unknown_context_vec(words)
     return vec
 
 
+def unknown_context_vec(words):
+    if conf.OOV_VECTORS == 'random':
+        return random_vec()
+    return hash_vec(' '.join(str(word['base']) for word in words))
+
+
+# returns None in random OOV_VECTORS mode, where unknown words get a new vector in every lookup
+def get_tokens_vectors(words):
+    if conf.OOV_VECTORS == 'random':
+        return None
+    return TokensVectors(words, conf.W2V_MODEL)
+
+
+# word vectors of all document tokens (interps excluded) embedded once, cumulative sums give
+# the same averages as get_context_vec for any contiguous span of tokens in constant time;
+# words are Tokens view of the document tokens table
+class TokensVectors:
+
+    def __init__(self, words, model):
+        self.words = words
+        # token table position -> position in words
+        self.positions = numpy.full(len(words.table), -1, dtype=numpy.int64)
+        for position, word in enumerate(words):
+            self.positions[word.position] = position
+        # words with vector, unknown words too if conf.RANDOM_WORD_VECTORS is set
+        self.known = numpy.zeros(len(words), dtype=bool)
+        vectors = numpy.zeros((len(words), conf.W2V_SIZE), dtype=numpy.float32)
+        for position, word in enumerate(words):
+            word_vec = get_wv(model, word['base'], conf.RANDOM_WORD_VECTORS)
+            if word_vec is not None:
+                vectors[position] = word_vec
+                self.known[position] = True
+
+        self.vectors_sums = numpy.zeros((len(words) + 1, conf.W2V_SIZE), dtype=numpy.float64)
+        numpy.cumsum(vectors, axis=0, out=self.vectors_sums[1:])
+        self.known_counts = numpy.zeros(len(words) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.known, out=self.known_counts[1:])
+
+    # (start, end) positions of words if they are a contiguous part of the document, None otherwise;
+    # contexts are views of the document tokens, so their positions are known without lookups
+    def get_span(self, words):
+        if len(words) == 0:
+            return None
+        if words.table is self.words.table and words.positions is self.words.positions:
+            return words.start - self.words.start, words.stop - self.words.start
+        start = self.positions[words[0].position]
+        end = self.positions[words[-1].position]
+        if start < 0 or end < 0 or end - start + 1 != len(words):
+            return None
+        return start, end + 1
+
+    def get_context_vec(self, words, start, end):
+        significant_words = self.known_counts[end] - self.known_counts[start]
+        if significant_words == 0:
+            return unknown_context_vec(words)
+        vec = (self.vectors_sums[end] - self.vectors_sums[start]) / float(significant_words)
+        return vec.astype(numpy.float32)
+
+
 def get_distance_bucket(distance):
     if 0 <= distance <= 4:
         return distance
@@ -515,16 +604,35 @@ def get_distance_bucket(distance):
     return 10
 
 
+# same buckets as get_distance_bucket for array of distances
+def get_distance_buckets(distances):
+    distances = numpy.asarray(distances, dtype=numpy.int64)
+    buckets = numpy.searchsorted([5, 8, 16, 32, 64], distances, side='right') + 4
+    buckets = numpy.where(distances <= 4, distances, buckets)
+    return numpy.where(distances < 0, 10, buckets)
+
+
+# same as check_one_way_acronym with initials of mention text computed once per mention
+def check_initials(acronym, mention):
+    if acronym == mention.initials:
+        return 1.0
+    return 0.0
+
+
 def check_one_way_acronym(acronym, expression):
+    if acronym == get_initials(expression):
+        return 1.0
+    return 0.0
+
+
+def get_initials(expression):
     initials = u''
     for expr1 in expression.split('-'):
         for expr2 in expr1.split():
             expr2 = expr2.strip()
             if expr2:
                 initials += expr2[0].upper()
-    if acronym == initials:
-        return 1.0
-    return 0.0
+    return initials
 
 
 def get_abbrev(mention):
@@ -535,55 +643,70 @@ def get_abbrev(mention):
     return abbrev
 
 
+# subsequence string kernel; levels are computed on whole matrices of the dynamic programming,
+# the discounted prefix sums (dp) are products with decay matrices, levels with no common
+# subsequence are not computed, since all the following ones are zero too
 def sk(s1, s2):
     lam = 0.4
 
-    p = len(s1)
-    if len(s2) < len(s1):
-        p = len(s2)
-
-    h, w = len(s1)+1, len(s2)+1
-    dps = [[0.0] * w for i in range(h)]
-    dp = [[0.0] * w for i in range(h)]
-
-    kernel_mat = [0.0] * (len(s1) + 1)
-
-    for i in range(len(s1)+1):
-        if i == 0:
-            continue
-        for j in range(len(s2)+1):
-            if j == 0:
-                continue
-            if s1[i-1] == s2[j-1]:
-                dps[i][j] = lam * lam
-                kernel_mat[0] += dps[i][j]
-            else:
-                dps[i][j] = 0.0
-
-    for m in range(p):
-        if m == 0:
-            continue
-
-        kernel_mat[m] = 0.0
-        for j in range(len(s2)+1):
-            dp[m-1][j] = 0.0
-
-        for i in range(len(s1)+1):
-            dp[i][m-1] = 0.0
-
-        for i in range(len(s1)+1):
-            if i < m:
-                continue
-            for j in range(len(s2)+1):
-                if j < m:
-                    continue
-                dp[i][j] = dps[i][j] + lam * dp[i - 1][j] + lam * dp[i][j - 1] - lam * lam * dp[i - 1][j - 1]
-
-                if s1[i-1] == s2[j-1]:
-                    dps[i][j] = lam * lam * dp[i - 1][j - 1]
-                    kernel_mat[m] += dps[i][j]
-
-    k = 0.0
-    for i in range(p):
-        k += kernel_mat[i]
-    return k
+    p = min(len(s1), len(s2))
+    if p == 0:
+        return 0.0
+
+    chars1 = numpy.frombuffer(s1.encode('utf-32-le'), dtype=numpy.uint32)
+    chars2 = numpy.frombuffer(s2.encode('utf-32-le'), dtype=numpy.uint32)
+    matches = chars1[:, numpy.newaxis] == chars2[numpy.newaxis, :]
+    decay = get_decay_matrix(max(len(s1), len(s2)), lam)
+
+    # dps of level m is nonzero only from position m in both strings, so it is kept from there
+    dps = numpy.where(matches, lam * lam, 0.0)
+    k = dps.sum()
+    for m in range(1, p):
+        h, w = dps.shape
+        dp = decay[:h, :h].dot(dps).dot(decay[:w, :w].T)
+        dps = lam * lam * dp[:-1, :-1] * matches[m:, m:]
+        if not dps.any():
+            break
+        k += dps.sum()
+    return float(k)
+
+
+# lower triangular matrix of lam ** (i - j)
+def get_decay_matrix(size, lam):
+    exponents = numpy.subtract.outer(numpy.arange(size), numpy.arange(size))
+    return numpy.tril(lam ** numpy.maximum(exponents, 0))
+
+
+# cross kernels are memoized on string pairs, since mention texts repeat within documents
+def get_kernel(s1, s2):
+    if s1 == s2:
+        return get_self_kernel(s1)
+    if (s1, s2) not in KERNELS_CACHE:
+        if len(KERNELS_CACHE) >= KERNELS_CACHE_SIZE:
+            KERNELS_CACHE.clear()
+        KERNELS_CACHE[(s1, s2)] = sk(s1, s2)
+    return KERNELS_CACHE[(s1, s2)]
+
+
+def get_self_kernel(string):
+    if string not in SELF_KERNELS_CACHE:
+        SELF_KERNELS_CACHE[string] = sk(string, string)
+    return SELF_KERNELS_CACHE[string]
+
+
+def normalized_kernel(s1, s2):
+    return get_kernel(s1, s2) / (math.sqrt(get_self_kernel(s1) * get_self_kernel(s2)))
+
+
+# string kernel has compiled version in accelerated.pyx, which replaces it if the module
+# is built (python corneferencer/build_accelerators.py); pure python version stays in PYTHON_FUNCTIONS
+ACCELERATED_FUNCTIONS = ['sk']
+PYTHON_FUNCTIONS = {name: globals()[name] for name in ACCELERATED_FUNCTIONS}
+
+try:
+    from corneferencer.resolvers import accelerated
+except ImportError:
+    accelerated = None
+else:
+    for name in ACCELERATED_FUNCTIONS:
+        globals()[name] = getattr(accelerated, name)
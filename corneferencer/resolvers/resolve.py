@@ -1,55 +1,59 @@
 import numpy
 from tqdm import tqdm
 
-from corneferencer.resolvers import features, vectors
+import conf
+from corneferencer.resolvers import features, scoring
 
 
-def siamese(text, threshold, neural_model):
-    last_set_id = 0
-    for i, ana in enumerate(text.mentions):
-        if i > 0:
-            for ante in reversed(text.mentions[:i]):
-                if not features.pair_intersect(ante, ana):
-                    pair_features = vectors.get_pair_features(ante, ana)
+# scores are (scores, scored) matrices of scoring.score_matrix, computed when not given
+# (e.g. loaded from cache or shared by runs with different thresholds)
+def get_scores(text, neural_model, batch_size, scores=None, siamese=False):
+    if scores is None:
+        return scoring.score_matrix(text.mentions, neural_model, batch_size, siamese)
+    return scores
 
-                    ante_vec = []
-                    ante_vec.extend(ante.features)
-                    ante_vec.extend(pair_features)
-                    ante_sample = numpy.asarray([ante_vec], dtype=numpy.float32)
 
-                    ana_vec = []
-                    ana_vec.extend(ana.features)
-                    ana_vec.extend(pair_features)
-                    ana_sample = numpy.asarray([ana_vec], dtype=numpy.float32)
+# positions of scored antecedent candidates of the anaphora (or anaphora candidates of the antecedent),
+# pairs out of candidates window and intersecting pairs are not scored
+def get_antecedents(scored, ana_position):
+    return numpy.flatnonzero(scored[:ana_position, ana_position]).tolist()
 
-                    prediction = neural_model.predict([ante_sample, ana_sample], verbose=0)[0]
 
-                    if prediction < threshold:
-                        if ante.set:
-                            ana.set = ante.set
-                        else:
-                            str_set_id = 'set_%d' % last_set_id
-                            ante.set = str_set_id
-                            ana.set = str_set_id
-                            last_set_id += 1
-                        break
+def get_anaphoras(scored, ante_position):
+    return (numpy.flatnonzero(scored[ante_position, ante_position + 1:]) + ante_position + 1).tolist()
+
+
+def siamese(text, threshold, neural_model, batch_size=conf.BATCH_SIZE, scores=None):
+    scores, scored = get_scores(text, neural_model, batch_size, scores, siamese=True)
+    last_set_id = 0
+    for i, ana in enumerate(text.mentions):
+        for j in reversed(get_antecedents(scored, i)):
+            ante = text.mentions[j]
+            prediction = scores[j, i]
+            if prediction < threshold:
+                if ante.set:
+                    ana.set = ante.set
+                else:
+                    str_set_id = 'set_%d' % last_set_id
+                    ante.set = str_set_id
+                    ana.set = str_set_id
+                    last_set_id += 1
+                break
 
 
 # incremental resolve algorithm
-def incremental(text, threshold, neural_model):
+def incremental(text, threshold, neural_model, batch_size=conf.BATCH_SIZE, scores=None):
+    scores, scored = get_scores(text, neural_model, batch_size, scores)
     last_set_id = 0
     for i, ana in enumerate(tqdm(text.mentions)):
         if i > 0:
             best_prediction = 0.0
             best_ante = None
-            for ante in text.mentions[:i]:
-                if not features.pair_intersect(ante, ana):
-                    pair_vec = vectors.get_pair_vector(ante, ana)
-                    sample = numpy.asarray([pair_vec], dtype=numpy.float32)
-                    prediction = neural_model.predict(sample, verbose=0)[0]
-                    if prediction > threshold and prediction >= best_prediction:
-                        best_prediction = prediction
-                        best_ante = ante
+            for j in get_antecedents(scored, i):
+                prediction = scores[j, i]
+                if prediction > threshold and prediction >= best_prediction:
+                    best_prediction = prediction
+                    best_ante = text.mentions[j]
             if best_ante is not None:
                 if best_ante.set:
                     ana.set = best_ante.set
@@ -61,21 +65,18 @@ def incremental(text, threshold, neural_model):
 
 
 # all2all resolve algorithm
-def all2all(text, threshold, neural_model):
+def all2all(text, threshold, neural_model, batch_size=conf.BATCH_SIZE, scores=None):
+    scores, scored = get_scores(text, neural_model, batch_size, scores)
     last_set_id = 0
     sets = text.get_sets()
     for pos1, mnt1 in enumerate(tqdm(text.mentions)):
         best_prediction = 0.0
         best_link = None
-        for pos2, mnt2 in enumerate(text.mentions):
-            if (pos2 > pos1 and
-                    (mnt1.set != mnt2.set or not mnt1.set or not mnt2.set)
-                    and not features.pair_intersect(mnt1, mnt2)):
-                ante = mnt1
-                ana = mnt2
-                pair_vec = vectors.get_pair_vector(ante, ana)
-                sample = numpy.asarray([pair_vec], dtype=numpy.float32)
-                prediction = neural_model.predict(sample, verbose=0)[0]
+        mnt1_set = mnt1.set
+        for pos2 in get_anaphoras(scored, pos1):
+            mnt2 = text.mentions[pos2]
+            if not mnt1_set or mnt1_set != mnt2.set or not mnt2.set:
+                prediction = scores[pos1, pos2]
                 if prediction > threshold and prediction > best_prediction:
                     best_prediction = prediction
                     best_link = mnt2
@@ -97,52 +98,60 @@ def all2all(text, threshold, neural_model):
 
 
 # entity based resolve algorithm
-def entity_based(text, threshold, neural_model):
+def entity_based(text, threshold, neural_model, batch_size=conf.BATCH_SIZE, scores=None):
+    scores, scored = get_scores(text, neural_model, batch_size, scores)
+    # pairs out of candidates window are left out of set predictions, intersecting pairs count as zero
+    counted = scored | features.overlap_matrix(text.mentions)
     sets = []
     last_set_id = 0
     for i, ana in enumerate(tqdm(text.mentions)):
         if i > 0:
-            best_fit = get_best_set(sets, ana, threshold, neural_model)
+            best_fit = get_best_set(sets, i, threshold, scores, counted)
             if best_fit is not None:
                 ana.set = best_fit['set_id']
                 best_fit['mentions'].append(ana)
+                best_fit['positions'].append(i)
             else:
                 str_set_id = 'set_%d' % last_set_id
                 sets.append({'set_id': str_set_id,
-                             'mentions': [ana]})
+                             'mentions': [ana],
+                             'positions': [i]})
                 ana.set = str_set_id
                 last_set_id += 1
         else:
             str_set_id = 'set_%d' % last_set_id
             sets.append({'set_id': str_set_id,
-                         'mentions': [ana]})
+                         'mentions': [ana],
+                         'positions': [i]})
             ana.set = str_set_id
             last_set_id += 1
 
     remove_singletons(sets)
 
 
-def get_best_set(sets, ana, threshold, neural_model):
+def get_best_set(sets, ana_position, threshold, scores, counted):
     best_prediction = 0.0
     best_set = None
     for s in sets:
-        accuracy = predict_set(s['mentions'], ana, neural_model)
+        accuracy = predict_set(s['positions'], ana_position, scores, counted)
         if accuracy > threshold and accuracy >= best_prediction:
             best_prediction = accuracy
             best_set = s
     return best_set
 
 
-def predict_set(mentions, ana, neural_model):
+# mean score of counted pairs; intersecting pairs are counted with zero score in the matrix,
+# pairs out of candidates window are not counted
+def predict_set(positions, ana_position, scores, counted):
     prediction_sum = 0.0
-    for mnt in mentions:
-        prediction = 0.0
-        if not features.pair_intersect(mnt, ana):
-            pair_vec = vectors.get_pair_vector(mnt, ana)
-            sample = numpy.asarray([pair_vec], dtype=numpy.float32)
-            prediction = neural_model.predict(sample, verbose=0)[0]
-        prediction_sum += prediction
-    return prediction_sum / float(len(mentions))
+    counted_pairs = 0
+    for position in positions:
+        if counted[position, ana_position]:
+            prediction_sum += scores[position, ana_position]
+            counted_pairs += 1
+    if counted_pairs == 0:
+        return 0.0
+    return prediction_sum / float(counted_pairs)
 
 
 def remove_singletons(sets):
@@ -152,21 +161,40 @@ def remove_singletons(sets):
 
 
 # closest resolve algorithm
-def closest(text, threshold, neural_model):
+def closest(text, threshold, neural_model, batch_size=conf.BATCH_SIZE, scores=None):
+    scores, scored = get_scores(text, neural_model, batch_size, scores)
     last_set_id = 0
     for i, ana in enumerate(text.mentions):
-        if i > 0:
-            for ante in reversed(text.mentions[:i]):
-                if not features.pair_intersect(ante, ana):
-                    pair_vec = vectors.get_pair_vector(ante, ana)
-                    sample = numpy.asarray([pair_vec], dtype=numpy.float32)
-                    prediction = neural_model.predict(sample, verbose=0)[0]
-                    if prediction > threshold:
-                        if ante.set:
-                            ana.set = ante.set
-                        else:
-                            str_set_id = 'set_%d' % last_set_id
-                            ante.set = str_set_id
-                            ana.set = str_set_id
-                            last_set_id += 1
-                        break
+        for j in reversed(get_antecedents(scored, i)):
+            ante = text.mentions[j]
+            prediction = scores[j, i]
+            if prediction > threshold:
+                if ante.set:
+                    ana.set = ante.set
+                else:
+                    str_set_id = 'set_%d' % last_set_id
+                    ante.set = str_set_id
+                    ana.set = str_set_id
+                    last_set_id += 1
+                break
+
+
+# resolve algorithms by name (constants.RESOLVERS), all of them take the same arguments,
+# so several of them may be run on the same scores of a text
+REGISTRY = {
+    'all2all': all2all,
+    'entity_based': entity_based,
+    'incremental': incremental,
+    'closest': closest,
+    'siamese': siamese,
+}
+# resolvers using scores of siamese architecture model
+SIAMESE_RESOLVERS = ['siamese']
+
+
+def resolve(text, resolver, threshold, neural_model, batch_size=conf.BATCH_SIZE, scores=None):
+    REGISTRY[resolver](text, threshold, neural_model, batch_size, scores)
+
+
+def uses_siamese_scores(resolver):
+    return resolver in SIAMESE_RESOLVERS
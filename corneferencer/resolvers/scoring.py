@@ -0,0 +1,199 @@
+import hashlib
+import os
+
+import numpy
+
+import conf
+from corneferencer.resolvers import features, vectors
+
+
+# candidates window limits distance between antecedent and anaphora candidates, in mentions, sentences
+# and paragraphs (0 means no limit); if keep_matching is set, pairs with the same text or the same head
+# are candidates regardless of their distance
+class CandidatesWindow:
+
+    def __init__(self, mentions=0, sentences=0, paragraphs=0, keep_matching=True):
+        self.mentions = mentions
+        self.sentences = sentences
+        self.paragraphs = paragraphs
+        self.keep_matching = keep_matching
+
+    def is_limited(self):
+        return self.mentions > 0 or self.sentences > 0 or self.paragraphs > 0
+
+    def get_key(self):
+        return [self.mentions, self.sentences, self.paragraphs, int(self.keep_matching)]
+
+    # mask[ante_position, ana_position] is True for pairs within the window
+    def get_mask(self, mentions):
+        mask = numpy.ones((len(mentions), len(mentions)), dtype=bool)
+        if self.mentions > 0:
+            mask &= get_distances(numpy.arange(len(mentions))) <= self.mentions
+        if self.sentences > 0:
+            mask &= get_distances([mnt.sentence_id for mnt in mentions]) <= self.sentences
+        if self.paragraphs > 0:
+            mask &= get_distances([mnt.paragraph_id for mnt in mentions]) <= self.paragraphs
+        if self.keep_matching and self.is_limited():
+            mask |= get_matches([mnt.lower_text for mnt in mentions])
+            mask |= get_matches([mnt.lower_head_orth for mnt in mentions])
+        return mask
+
+
+def get_window(mentions=conf.MAX_MENTION_DISTANCE, sentences=conf.MAX_SENTENCE_DISTANCE,
+               paragraphs=conf.MAX_PARAGRAPH_DISTANCE, keep_matching=conf.KEEP_MATCHING_CANDIDATES):
+    return CandidatesWindow(mentions, sentences, paragraphs, keep_matching)
+
+
+def get_distances(values):
+    values = numpy.asarray(values, dtype=numpy.int64)
+    return numpy.abs(values[None, :] - values[:, None])
+
+
+# empty values do not match
+def get_matches(values):
+    codes = {}
+    values_codes = numpy.asarray([codes.setdefault(value, len(codes)) if value else -1 for value in values],
+                                 dtype=numpy.int64)
+    return (values_codes[None, :] == values_codes[:, None]) & (values_codes[:, None] >= 0)
+
+
+# candidate pairs are (ante_position, ana_position) tuples with ante_position < ana_position
+def candidate_pairs(mentions, window=None):
+    candidates = ~features.overlap_matrix(mentions)
+    if window is not None and window.is_limited():
+        candidates &= window.get_mask(mentions)
+    anas, antes = numpy.nonzero(numpy.tril(candidates.T, -1))
+    return list(zip(antes.tolist(), anas.tolist()))
+
+
+# window defaults to the one from configuration
+def score_matrix(mentions, neural_model, batch_size, siamese=False, window=None):
+    if window is None:
+        window = get_window()
+    mentions_count = len(mentions)
+    scores = numpy.zeros((mentions_count, mentions_count), dtype=numpy.float32)
+    scored = numpy.zeros((mentions_count, mentions_count), dtype=bool)
+
+    pairs = candidate_pairs(mentions, window)
+    if pairs:
+        pairs_scores = score_pairs(mentions, pairs, neural_model, batch_size, siamese)
+        antes, anas = numpy.asarray(pairs, dtype=numpy.int64).T
+        scores[antes, anas] = pairs_scores
+        scored[antes, anas] = True
+
+    return scores, scored
+
+
+# number of not overlapping pairs, which were not scored because of candidates window
+def count_pruned_pairs(mentions, scored):
+    mentions_count = len(mentions)
+    all_pairs = mentions_count * (mentions_count - 1) // 2 - int(numpy.count_nonzero(
+        numpy.triu(features.overlap_matrix(mentions), 1)))
+    return all_pairs - int(numpy.count_nonzero(scored))
+
+
+# score matrices are cached in npz files (one per document), cached matrices are used only for the same model
+# (model_key describes model file, its modification time, size and backend), the same features settings,
+# the same mentions, the same kind of scores and the same candidates window
+def cached_score_matrix(mentions, neural_model, model_key, batch_size, cache_path, siamese=False, window=None):
+    if window is None:
+        window = get_window()
+    cache_key = get_cache_key(mentions, model_key, siamese, window)
+    cached = load_score_matrix(cache_path, cache_key)
+    if cached is not None:
+        return cached
+    scores, scored = score_matrix(mentions, neural_model, batch_size, siamese, window)
+    save_score_matrix(cache_path, cache_key, scores, scored)
+    return scores, scored
+
+
+def load_score_matrix(cache_path, cache_key):
+    if not os.path.isfile(cache_path):
+        return None
+    with numpy.load(cache_path) as cache:
+        if 'key' in cache.files and str(cache['key']) == cache_key:
+            return cache['scores'], cache['scored']
+    return None
+
+
+# written to temporary file first, so that interrupted runs do not leave broken cache files
+def save_score_matrix(cache_path, cache_key, scores, scored):
+    tmp_path = '%s.tmp' % cache_path
+    with open(tmp_path, 'wb') as cache_file:
+        numpy.savez_compressed(cache_file, scores=scores, scored=scored, key=numpy.asarray(cache_key))
+    os.replace(tmp_path, cache_path)
+
+
+def get_cache_key(mentions, model_key, siamese, window):
+    return '\n'.join([model_key,
+                      'oov_vectors=%s' % conf.OOV_VECTORS,
+                      'random_word_vectors=%s' % conf.RANDOM_WORD_VECTORS,
+                      'w2v_model=%s' % os.path.abspath(conf.W2V_MODEL_PATH),
+                      'siamese=%s' % siamese,
+                      'window=%s' % window.get_key(),
+                      'mentions=%s' % get_mentions_digest(mentions)])
+
+
+# digest of mentions and their texts and contexts, so that edited input with the same mentions ids is not matched
+def get_mentions_digest(mentions):
+    digest = hashlib.sha1()
+    for mnt in mentions:
+        mention_key = [mnt.id, str(mnt.span), mnt.text, mnt.lemmatized_text, str(mnt.head_orth)]
+        for words in (mnt.prec_context, mnt.follow_context, mnt.sentence):
+            mention_key.append(' '.join(word['orth'] for word in words))
+        digest.update(('\t'.join(mention_key) + '\n').encode('utf-8'))
+    return digest.hexdigest()
+
+
+def score_pairs(mentions, pairs, neural_model, batch_size, siamese=False):
+    mentions_features = get_mentions_features(mentions)
+    mentions_columns = vectors.MentionsColumns(mentions)
+    if is_factorized(neural_model) and not siamese:
+        return score_pairs_factorized(pairs, neural_model, batch_size, mentions_features, mentions_columns)
+
+    scores = numpy.zeros(len(pairs), dtype=numpy.float32)
+    for batch_start in range(0, len(pairs), batch_size):
+        batch = pairs[batch_start:batch_start + batch_size]
+        if siamese:
+            samples = get_siamese_samples(mentions_features, mentions_columns, batch)
+        else:
+            samples = get_samples(mentions_features, mentions_columns, batch)
+        predictions = neural_model.predict(samples, batch_size=batch_size, verbose=0)
+        scores[batch_start:batch_start + len(batch)] = numpy.asarray(predictions).reshape(-1)
+    return scores
+
+
+# per mention first layer projections are computed once, only the pair block is multiplied per pair
+def score_pairs_factorized(pairs, neural_model, batch_size, mentions_features, mentions_columns):
+    ante_projections, ana_projections = neural_model.project_mentions(mentions_features)
+    scores = numpy.zeros(len(pairs), dtype=numpy.float32)
+    for batch_start in range(0, len(pairs), batch_size):
+        batch = pairs[batch_start:batch_start + batch_size]
+        antes, anas = numpy.asarray(batch, dtype=numpy.int64).T
+        predictions = neural_model.predict_pairs(ante_projections[antes], ana_projections[anas],
+                                                 mentions_columns.get_pairs_features(batch), batch_size)
+        scores[batch_start:batch_start + len(batch)] = numpy.asarray(predictions).reshape(-1)
+    return scores
+
+
+def is_factorized(neural_model):
+    return hasattr(neural_model, 'project_mentions')
+
+
+def get_mentions_features(mentions):
+    return numpy.asarray([mnt.features for mnt in mentions], dtype=numpy.float32)
+
+
+def get_samples(mentions_features, mentions_columns, pairs):
+    antes, anas = numpy.asarray(pairs, dtype=numpy.int64).T
+    return numpy.hstack((mentions_features[antes],
+                         mentions_features[anas],
+                         mentions_columns.get_pairs_features(pairs)))
+
+
+def get_siamese_samples(mentions_features, mentions_columns, pairs):
+    antes, anas = numpy.asarray(pairs, dtype=numpy.int64).T
+    pairs_features = mentions_columns.get_pairs_features(pairs)
+    ante_samples = numpy.hstack((mentions_features[antes], pairs_features))
+    ana_samples = numpy.hstack((mentions_features[anas], pairs_features))
+    return [ante_samples, ana_samples]
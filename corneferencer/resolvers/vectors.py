@@ -1,4 +1,8 @@
-from corneferencer.resolvers import features
+
+import numpy
+
+import conf
+from corneferencer.resolvers import constants, features
 
 
 def get_pair_vector(ante, ana):
@@ -87,3 +91,228 @@ def get_pair_features(ante, ana):
     vec.append(features.adjsent_anapron_adjmen(ante, ana))
 
     return vec
+
+
+# pair features of many mention pairs at once, rows are equal to get_pair_features;
+# pairs are (ante_position, ana_position) tuples or mentions_count x mentions_count boolean mask
+def get_pairs_features(mentions, pairs):
+    return MentionsColumns(mentions).get_pairs_features(pairs)
+
+
+# per mention features needed by pair features as integer coded arrays, equal strings have equal codes
+class MentionsColumns:
+
+    def __init__(self, mentions):
+        self.codes = {}
+        self.overlaps = features.overlap_matrix(mentions)
+
+        self.start_in_words = self.to_array([mnt.start_in_words for mnt in mentions])
+        self.end_in_words = self.to_array([mnt.end_in_words for mnt in mentions])
+        self.positions = self.to_array([mnt.position_in_mentions for mnt in mentions])
+        self.sentence_ids = self.to_array([mnt.sentence_id for mnt in mentions])
+        self.paragraph_ids = self.to_array([mnt.paragraph_id for mnt in mentions])
+        self.first_in_paragraph = self.to_array([bool(mnt.first_in_paragraph) for mnt in mentions])
+        self.zero_or_pronoun = self.to_array([features.is_zero_or_pronoun(mnt) == 1.0 for mnt in mentions])
+
+        self.texts = self.encode([mnt.text for mnt in mentions])
+        self.lower_texts = self.encode([mnt.lower_text for mnt in mentions])
+        self.lower_bases = self.encode([mnt.lower_lemmatized_text for mnt in mentions])
+        self.head_orths = self.encode([mnt.head_orth for mnt in mentions])
+        self.lower_head_orths = self.encode([mnt.lower_head_orth for mnt in mentions])
+        self.upper_texts = self.to_array([mnt.is_upper for mnt in mentions])
+        self.initials = self.encode([mnt.initials for mnt in mentions])
+        self.abbrevs = self.encode([mnt.abbrev for mnt in mentions])
+        self.rarest_bases = self.encode([mnt.rarest['base'] for mnt in mentions])
+
+        self.has_head = self.to_array([mnt.head is not None for mnt in mentions])
+        self.head_bases = self.encode([mnt.head['base'] if mnt.head is not None else None for mnt in mentions])
+        self.head_tags = {}
+        self.unknown_head_tags = {}
+        for tag_name in ['gender', 'number', 'person']:
+            tags = [mnt.head[tag_name] if mnt.head is not None else 'unk' for mnt in mentions]
+            self.head_tags[tag_name] = self.encode(tags)
+            self.unknown_head_tags[tag_name] = self.to_array([tag == 'unk' for tag in tags])
+        self.masculine_heads = self.to_array([mnt.head is not None and mnt.head['gender'] in constants.MASCULINE_TAGS
+                                              for mnt in mentions])
+
+        self.words_bases = Relation(len(mentions), len(self.codes))
+        for position, mnt in enumerate(mentions):
+            for base in mnt.words_bases:
+                if base in self.codes:
+                    self.words_bases.add(position, self.codes[base])
+
+        lower_texts = set(mnt.lower_text for mnt in mentions)
+        self.prefixes = self.get_relation(lower_texts, lambda text: [text[:end] for end in range(len(text) + 1)])
+        self.suffixes = self.get_relation(lower_texts, lambda text: [text[start:] for start in range(len(text) + 1)])
+
+        head_bases = set(mnt.head['base'] for mnt in mentions if mnt.head is not None)
+        self.synonyms = self.get_relation(head_bases, lambda base: get_map_value(conf.LEMMA2SYNONYMS, base, set()))
+        self.hypernyms = self.get_relation(head_bases, lambda base: get_map_value(conf.LEMMA2HYPERNYMS, base, set()))
+        self.has_hypernyms = self.to_array([mnt.head is not None and bool(get_map_value(conf.LEMMA2HYPERNYMS,
+                                                                                        mnt.head['base'], set()))
+                                            for mnt in mentions])
+
+        lower_bases = set(mnt.lower_lemmatized_text for mnt in mentions)
+        self.links = self.get_relation(lower_bases, lambda base: get_map_value(conf.TITLE2LINKS, base, set()))
+        self.redirects = self.to_array([self.codes.get(get_map_value(conf.TITLE2REDIRECT,
+                                                                     mnt.lower_lemmatized_text, None), -1)
+                                        for mnt in mentions])
+
+    @staticmethod
+    def to_array(values):
+        if values and isinstance(values[0], bool):
+            return numpy.asarray(values, dtype=bool)
+        return numpy.asarray(values, dtype=numpy.int64)
+
+    def encode(self, strings):
+        return self.to_array([self.codes.setdefault(string, len(self.codes)) for string in strings])
+
+    # relation between codes of given strings and codes of related strings which are mention strings too
+    def get_relation(self, strings, get_related):
+        relation = Relation(len(self.codes), len(self.codes))
+        for string in strings:
+            for related in get_related(string):
+                if related in self.codes:
+                    relation.add(self.codes[string], self.codes[related])
+        return relation
+
+    def get_pairs_features(self, pairs):
+        if isinstance(pairs, numpy.ndarray) and pairs.dtype == bool:
+            antes, anas = numpy.nonzero(pairs)
+        else:
+            pairs = numpy.asarray(pairs, dtype=numpy.int64).reshape(-1, 2)
+            antes, anas = pairs[:, 0], pairs[:, 1]
+
+        columns = []
+        columns.extend(self.distances_vec(antes, anas))
+        columns.append(self.lower_head_orths[antes] == self.lower_head_orths[anas])
+        columns.append(self.lower_texts[antes] == self.lower_texts[anas])
+        columns.append(self.lower_bases[antes] == self.lower_bases[anas])
+
+        # complementary features
+        columns.append(self.words_bases.contains(antes, self.rarest_bases[anas]))
+        number_agreement = self.agreement(antes, anas, 'number')
+        person_agreement = self.agreement(antes, anas, 'person')
+        columns.extend(self.agreement(antes, anas, 'gender'))
+        columns.extend(number_agreement)
+        columns.extend(person_agreement)
+        columns.append(self.is_acronym(antes, anas))
+        same_sentence = self.sentence_ids[antes] == self.sentence_ids[anas]
+        columns.append(same_sentence)
+        columns.append(self.paragraph_ids[antes] == self.paragraph_ids[anas])
+
+        # complementary features 2
+        sentence_distances = self.sentence_ids[anas] - self.sentence_ids[antes]
+        columns.append(sentence_distances == 1)
+        columns.append(sentence_distances == 2)
+        columns.append(sentence_distances > 2)
+        columns.extend(self.flat_gender_agreement(antes, anas))
+        columns.append(self.prefixes.contains(self.lower_texts[antes], self.lower_texts[anas]) |
+                       self.prefixes.contains(self.lower_texts[anas], self.lower_texts[antes]))
+        columns.append(self.suffixes.contains(self.lower_texts[antes], self.lower_texts[anas]) |
+                       self.suffixes.contains(self.lower_texts[anas], self.lower_texts[antes]))
+        columns.append((self.head_orths[antes] == self.abbrevs[anas]) | (self.head_orths[anas] == self.abbrevs[antes]))
+
+        columns.append(self.string_kernel(self.texts[antes], self.texts[anas]))
+        columns.append(self.string_kernel(self.head_orths[antes], self.head_orths[anas]))
+
+        columns.extend(self.wordnet_vec(antes, anas))
+        columns.extend(self.wikipedia_vec(antes, anas))
+
+        # combined features
+        pronoun_anas = self.zero_or_pronoun[anas]
+        first_in_paragraph_antes = self.first_in_paragraph[antes]
+        adjacent_mentions = self.positions[anas] - self.positions[antes] == 1
+        person_number_match = number_agreement[0] & person_agreement[0]
+        columns.append(same_sentence & pronoun_anas & first_in_paragraph_antes)
+        columns.append(same_sentence & first_in_paragraph_antes & person_number_match)
+        columns.append((sentence_distances == 1) & pronoun_anas & adjacent_mentions & person_number_match)
+        columns.append((sentence_distances == 1) & pronoun_anas & adjacent_mentions)
+
+        return numpy.column_stack(columns).astype(numpy.float32)
+
+    def distances_vec(self, antes, anas):
+        intersect = self.overlaps[antes, anas]
+        words_buckets = features.get_distance_buckets(self.start_in_words[anas] - self.end_in_words[antes])
+        words_buckets[intersect] = 0
+        mentions_buckets = features.get_distance_buckets(self.positions[anas] - self.positions[antes])
+        mentions_buckets[intersect] = 0
+        mentions_buckets[words_buckets == 10] = 10
+        return one_hot(words_buckets, 11) + one_hot(mentions_buckets, 11) + [intersect]
+
+    def agreement(self, antes, anas, tag_name):
+        unknown = self.unknown_head_tags[tag_name][antes] | self.unknown_head_tags[tag_name][anas]
+        same = self.head_tags[tag_name][antes] == self.head_tags[tag_name][anas]
+        return [~unknown & same, ~unknown & ~same, unknown]
+
+    def flat_gender_agreement(self, antes, anas):
+        unknown = self.unknown_head_tags['gender'][antes] | self.unknown_head_tags['gender'][anas]
+        same = ((self.head_tags['gender'][antes] == self.head_tags['gender'][anas]) |
+                (self.masculine_heads[antes] & self.masculine_heads[anas]))
+        return [~unknown & same, ~unknown & ~same, unknown]
+
+    def is_acronym(self, antes, anas):
+        ana_acronym = self.texts[anas] == self.initials[antes]
+        ante_acronym = self.texts[antes] == self.initials[anas]
+        return numpy.where(self.upper_texts[anas], ana_acronym, self.upper_texts[antes] & ante_acronym)
+
+    # kernel values are computed once for every pair of distinct strings
+    def string_kernel(self, codes1, codes2):
+        if len(codes1) == 0:
+            return numpy.zeros(0, dtype=numpy.float64)
+        strings = {code: string for string, code in self.codes.items()}
+        code_pairs, inverse = numpy.unique(numpy.stack([codes1, codes2], axis=1), axis=0, return_inverse=True)
+        values = numpy.zeros(len(code_pairs), dtype=numpy.float64)
+        for idx, (code1, code2) in enumerate(code_pairs.tolist()):
+            values[idx] = features.normalized_kernel(strings[code1], strings[code2])
+        return values[inverse.reshape(-1)]
+
+    def wordnet_vec(self, antes, anas):
+        has_heads = self.has_head[antes] & self.has_head[anas]
+        ante_bases = self.head_bases[antes]
+        ana_bases = self.head_bases[anas]
+        has_hypernyms = self.has_hypernyms[antes] & self.has_hypernyms[anas]
+        synonyms = self.synonyms.contains(ante_bases, ana_bases) | self.synonyms.contains(ana_bases, ante_bases)
+        return [has_heads & synonyms,
+                has_heads & has_hypernyms & self.hypernyms.contains(ante_bases, ana_bases),
+                has_heads & has_hypernyms & self.hypernyms.contains(ana_bases, ante_bases)]
+
+    def wikipedia_vec(self, antes, anas):
+        ante_bases = self.lower_bases[antes]
+        ana_bases = self.lower_bases[anas]
+        same = ante_bases == ana_bases
+        ante_links = self.links.contains(ante_bases, ana_bases)
+        ana_links = self.links.contains(ana_bases, ante_bases)
+        redirect = (self.redirects[antes] == ana_bases) | (self.redirects[anas] == ante_bases)
+        return [same | ante_links | ana_links,
+                same | (ante_links & ana_links),
+                same | redirect]
+
+
+# set of (row, column) pairs of integer codes checked for whole arrays at once
+class Relation:
+
+    def __init__(self, rows_count, columns_count):
+        self.columns_count = max(columns_count, 1)
+        self.keys = set()
+        self.sorted_keys = None
+
+    def add(self, row, column):
+        self.keys.add(row * self.columns_count + column)
+        self.sorted_keys = None
+
+    def contains(self, rows, columns):
+        if self.sorted_keys is None:
+            self.sorted_keys = numpy.asarray(sorted(self.keys), dtype=numpy.int64)
+        keys = rows * self.columns_count + columns
+        return (columns >= 0) & numpy.isin(keys, self.sorted_keys)
+
+
+def one_hot(indices, size):
+    return [indices == value for value in range(size)]
+
+
+def get_map_value(this_map, key, default):
+    if key in this_map:
+        return this_map[key]
+    return default
@@ -0,0 +1,257 @@
+import json
+import os
+import timeit
+from collections.abc import Mapping
+
+import numpy
+
+import corneferencer.utils as utils
+from corneferencer.utils import eprint, get_memory_usage
+
+
+class ResourceManager:
+
+    def __init__(self):
+        self.loaders = {}
+        self.resources = {}
+
+    def register(self, name, loader):
+        self.loaders[name] = loader
+
+    def is_registered(self, name):
+        return name in self.loaders
+
+    def is_loaded(self, name):
+        return name in self.resources
+
+    def get(self, name):
+        if name not in self.resources:
+            self.resources[name] = self.load(name)
+        return self.resources[name]
+
+    def load(self, name):
+        start_time = timeit.default_timer()
+        start_memory = get_memory_usage()
+        resource = self.loaders[name]()
+        eprint("Resource %s loaded in %.2f s (%+.1f MB)" %
+               (name, timeit.default_timer() - start_time, get_memory_usage() - start_memory))
+        return resource
+
+    def preload(self, names=None):
+        if names is None:
+            names = list(self.loaders)
+        for name in names:
+            self.get(name)
+
+
+# bundles are files of named arrays, memory-mapped when loaded, so that worker
+# processes share one page cache copy; strings are kept in sorted utf-8 string tables
+BUNDLE_MAGIC = b'CORNEFERENCER-BUNDLE-1\n'
+ENCODING_ERRORS = 'surrogatepass'
+
+# compact replacement of java serialized maps
+MAP_BUNDLE_SUFFIX = '.bundle'
+# word vectors of word2vec model without the training weights
+EMBEDDINGS_BUNDLE_SUFFIX = '.vectors.bundle'
+
+
+def load_map(map_path, one2many=True):
+    bundle_path = map_path + MAP_BUNDLE_SUFFIX
+    if os.path.exists(bundle_path):
+        return StringTableMap(bundle_path)
+    if one2many:
+        return utils.load_one2many_map(map_path)
+    return utils.load_one2one_map(map_path)
+
+
+def load_embeddings(model_path):
+    bundle_path = model_path + EMBEDDINGS_BUNDLE_SUFFIX
+    if os.path.exists(bundle_path):
+        return MappedKeyedVectors(bundle_path)
+    return utils.load_w2v_model(model_path)
+
+
+def save_map_bundle(this_map, bundle_path, one2many=True):
+    items = sorted((encode(key), value) for key, value in this_map.items())
+
+    value_offsets = [0]
+    groups = [0]
+    values_table = bytearray()
+    for key, value in items:
+        values = sorted(value) if one2many else [value]
+        for element in values:
+            values_table += encode(element)
+            value_offsets.append(len(values_table))
+        groups.append(len(value_offsets) - 1)
+
+    key_offsets, keys_table = to_string_table([key for key, value in items])
+    arrays = [('key_offsets', key_offsets),
+              ('keys', keys_table),
+              ('value_offsets', numpy.asarray(value_offsets, dtype=numpy.int64)),
+              ('values', numpy.frombuffer(bytes(values_table), dtype=numpy.uint8)),
+              ('groups', numpy.asarray(groups, dtype=numpy.int64))]
+    save_bundle(bundle_path, arrays, {'one2many': one2many})
+
+
+# vectors are reordered to follow the sorted words
+def save_embeddings_bundle(words, vectors, bundle_path):
+    order = sorted(range(len(words)), key=lambda position: encode(words[position]))
+    key_offsets, keys_table = to_string_table([encode(words[position]) for position in order])
+    vectors = numpy.asarray(vectors, dtype=numpy.float32)[order]
+    arrays = [('key_offsets', key_offsets),
+              ('keys', keys_table),
+              ('vectors', vectors.reshape(-1))]
+    save_bundle(bundle_path, arrays, {'vector_size': vectors.shape[1]})
+
+
+def to_string_table(encoded_strings):
+    offsets = numpy.zeros(len(encoded_strings) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(string) for string in encoded_strings])
+    table = numpy.frombuffer(b''.join(encoded_strings), dtype=numpy.uint8)
+    return offsets, table
+
+
+def save_bundle(bundle_path, arrays, header):
+    header = dict(header, arrays={})
+    offset = 0
+    for name, array in arrays:
+        header['arrays'][name] = [offset, array.size, array.dtype.str]
+        offset += align(array.nbytes)
+    header_bytes = BUNDLE_MAGIC + json.dumps(header).encode('utf-8') + b'\n'
+    data_start = align(len(header_bytes))
+
+    with open(bundle_path, 'wb') as bundle_file:
+        bundle_file.write(header_bytes.ljust(data_start, b' '))
+        for name, array in arrays:
+            bundle_file.write(array.tobytes().ljust(align(array.nbytes), b'\0'))
+
+
+def load_bundle(bundle_path):
+    with open(bundle_path, 'rb') as bundle_file:
+        if bundle_file.readline() != BUNDLE_MAGIC:
+            raise ValueError('%s is not a bundle!' % bundle_path)
+        header_line = bundle_file.readline()
+        header = json.loads(header_line.decode('utf-8'))
+    data_start = align(len(BUNDLE_MAGIC) + len(header_line))
+
+    arrays = {}
+    for name, (offset, size, dtype) in header['arrays'].items():
+        if size == 0:
+            arrays[name] = numpy.zeros(0, dtype=dtype)
+        else:
+            arrays[name] = numpy.memmap(bundle_path, dtype=dtype, mode='r',
+                                        offset=data_start + offset, shape=(size,))
+    return header, arrays
+
+
+def encode(string):
+    return string.encode('utf-8', ENCODING_ERRORS)
+
+
+def decode(string_bytes):
+    return bytes(string_bytes).decode('utf-8', ENCODING_ERRORS)
+
+
+def align(size, alignment=8):
+    return (size + alignment - 1) // alignment * alignment
+
+
+class StringTable:
+
+    def __init__(self, offsets, table):
+        self.offsets = offsets
+        self.table = table
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, position):
+        return bytes(self.table[self.offsets[position]:self.offsets[position + 1]])
+
+    # position of string in sorted table or None
+    def find(self, string):
+        if not isinstance(string, str):
+            return None
+        string_bytes = encode(string)
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.get(middle) < string_bytes:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.get(low) == string_bytes:
+            return low
+        return None
+
+
+class StringTableMap(Mapping):
+
+    def __init__(self, bundle_path):
+        header, arrays = load_bundle(bundle_path)
+        self.one2many = header['one2many']
+        self.key_table = StringTable(arrays['key_offsets'], arrays['keys'])
+        self.value_table = StringTable(arrays['value_offsets'], arrays['values'])
+        self.groups = arrays['groups']
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.key_table)
+
+    def __iter__(self):
+        for position in range(len(self.key_table)):
+            yield decode(self.key_table.get(position))
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __getitem__(self, key):
+        value = self.find(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def find(self, key):
+        if key not in self.cache:
+            position = self.key_table.find(key)
+            self.cache[key] = None if position is None else self.get_value(position)
+        return self.cache[key]
+
+    def get_value(self, position):
+        values = [decode(self.value_table.get(element))
+                  for element in range(self.groups[position], self.groups[position + 1])]
+        if self.one2many:
+            return frozenset(values)
+        return values[0]
+
+
+# read-only replacement of gensim word2vec model used for word vectors lookup (model.wv[word])
+class MappedKeyedVectors:
+
+    def __init__(self, bundle_path):
+        header, arrays = load_bundle(bundle_path)
+        self.vector_size = header['vector_size']
+        self.words = StringTable(arrays['key_offsets'], arrays['keys'])
+        self.vectors = arrays['vectors'].reshape(-1, self.vector_size)
+        self.cache = {}
+
+    @property
+    def wv(self):
+        return self
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return self.find(word) is not None
+
+    def __getitem__(self, word):
+        position = self.find(word)
+        if position is None:
+            raise KeyError(word)
+        return self.vectors[position]
+
+    def find(self, word):
+        if word not in self.cache:
+            self.cache[word] = self.words.find(word)
+        return self.cache[word]
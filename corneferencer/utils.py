@@ -1,104 +1,126 @@
 from __future__ import print_function
 
 import codecs
+import os
+import resource
+import shutil
 import sys
+import timeit
 
 import javaobj
+import numpy
 
-from tensorflow.keras.models import Sequential, Model
-from tensorflow.keras.layers import Input, Dense, Dropout, Activation, BatchNormalization, Lambda
-from tensorflow.keras import backend as K
+
+NEURAL_MODEL_BACKENDS = ['keras', 'numpy']
+
+# models loaded in this process, see get_neural_model
+NEURAL_MODELS = {}
 
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def initialize_neural_model(architecture, number_of_features, path_to_model):
+# loads (and warms up) every model only once per process
+def get_neural_model(architecture, number_of_features, path_to_model, factorized=False, backend='keras'):
+    key = (architecture, number_of_features, os.path.abspath(path_to_model), factorized, backend)
+    if key not in NEURAL_MODELS:
+        start_time = timeit.default_timer()
+        model = initialize_neural_model(architecture, number_of_features, path_to_model, factorized, backend)
+        warm_up_neural_model(model, architecture, number_of_features)
+        eprint("Neural model %s (%s, %s backend) loaded in %.2f s" %
+               (path_to_model, architecture, backend, timeit.default_timer() - start_time))
+        NEURAL_MODELS[key] = model
+    return NEURAL_MODELS[key]
+
+
+# description of a model loaded by get_neural_model (model file with its modification time and size,
+# architecture, backend), models loaded otherwise are described by their repr
+def get_neural_model_key(model):
+    for key, loaded_model in NEURAL_MODELS.items():
+        if loaded_model is model:
+            architecture, number_of_features, path_to_model, factorized, backend = key
+            model_stat = os.stat(path_to_model)
+            return 'model=%s mtime=%d size=%d architecture=%s features=%d factorized=%s backend=%s' % (
+                path_to_model, model_stat.st_mtime_ns, model_stat.st_size, architecture, number_of_features,
+                factorized, backend)
+    return 'model=%r' % model
+
+
+def warm_up_neural_model(model, architecture, number_of_features):
+    sample = numpy.zeros((1, number_of_features), dtype=numpy.float32)
+    if architecture == 'siamese':
+        model.predict([sample, sample], verbose=0)
+    elif model is not None:
+        model.predict(sample, verbose=0)
+
+
+# backends are imported on demand, so the numpy backend runs without tensorflow
+def initialize_neural_model(architecture, number_of_features, path_to_model, factorized=False, backend='keras'):
+    if backend == 'numpy':
+        from corneferencer import numpy_model as backend_module
+    else:
+        from corneferencer import keras_model as backend_module
+
     model = None
     if architecture == 'simple':
-        model = initialize_simple_model(number_of_features, path_to_model)
+        model = backend_module.initialize_simple_model(number_of_features, path_to_model)
+        if factorized:
+            model = backend_module.factorize_simple_model(model)
     elif architecture == 'siamese':
-        model = initialize_siamese_model(number_of_features, path_to_model)
-    return model
-
-
-def initialize_simple_model(number_of_features, path_to_model):
-    inputs = Input(shape=(number_of_features,))
-
-    output_from_1st_layer = Dense(1000)(inputs)
-    output_from_1st_layer = BatchNormalization()(output_from_1st_layer)
-    output_from_1st_layer = Activation('relu')(output_from_1st_layer)
-    output_from_1st_layer = Dropout(0.2)(output_from_1st_layer)
-
-    output_from_2nd_layer = Dense(500)(output_from_1st_layer)
-    output_from_2nd_layer = BatchNormalization()(output_from_2nd_layer)
-    output_from_2nd_layer = Activation('relu')(output_from_2nd_layer)
-    output_from_2nd_layer = Dropout(0.2)(output_from_2nd_layer)
-
-    output_from_3rd_layer = Dense(300)(output_from_2nd_layer)
-    output_from_3rd_layer = BatchNormalization()(output_from_3rd_layer)
-    output_from_3rd_layer = Activation('relu')(output_from_3rd_layer)
-    output_from_3rd_layer = Dropout(0.2)(output_from_3rd_layer)
-
-    output = Dense(1, activation='sigmoid')(output_from_3rd_layer)
-
-    model = Model(inputs, output)
-    model.compile(optimizer='Adam', loss='binary_crossentropy', metrics=['accuracy'])
-    print(path_to_model)
-    model.load_weights(path_to_model)
-
-    return model
-
-
-def initialize_siamese_model(number_of_features, path_to_model):
-    input_dim = number_of_features
-
-    base_network = create_base_network(input_dim)
-
-    input_a = Input(shape=(input_dim,))
-    input_b = Input(shape=(input_dim,))
-
-    processed_a = base_network(input_a)
-    processed_b = base_network(input_b)
-
-    distance = Lambda(euclidean_distance, output_shape=eucl_dist_output_shape)([processed_a, processed_b])
-
-    model = Model([input_a, input_b], distance)
-    model.compile(loss=contrastive_loss, optimizer='Adam')
-    model.load_weights(path_to_model)
-
+        if factorized:
+            eprint("Warning: Factorized inference is not available for siamese architecture!")
+        model = backend_module.initialize_siamese_model(number_of_features, path_to_model)
     return model
 
 
-def create_base_network(input_dim):
-    seq = Sequential()
-
-    seq.add(Dense(1000, input_shape=(input_dim,), activation='relu'))
-    seq.add(Dropout(0.2))
-    seq.add(BatchNormalization())
-
-    seq.add(Dense(500, activation='relu'))
-    seq.add(Dropout(0.2))
-    seq.add(BatchNormalization())
-
-    seq.add(Dense(300, activation='relu'))
-    return seq
-
-
-def euclidean_distance(vects):
-    x, y = vects
-    return K.sqrt(K.maximum(K.sum(K.square(x - y), axis=1, keepdims=True), K.epsilon()))
-
-
-def eucl_dist_output_shape(shapes):
-    shape1, shape2 = shapes
-    return shape1[0], 1
-
-
-def contrastive_loss(y_true, y_pred):
-    margin = 1
-    return K.mean(y_true * K.square(y_pred) + (1 - y_true) * K.square(K.maximum(margin - y_pred, 0)))
+def get_memory_usage():
+    # resident set size in MB
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+    except (IOError, OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# unchanged files are hardlinked when link is set, symlinked if hardlinks are not possible
+# (e.g. across filesystems) and copied if neither is possible; existing destination is replaced,
+# so that the source is never written through links left by previous runs
+def copy_file(src, dest, link=False):
+    if os.path.lexists(dest) and os.path.abspath(dest) != os.path.abspath(src):
+        os.remove(dest)
+    if link:
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            pass
+        try:
+            os.symlink(os.path.abspath(src), dest)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dest)
+
+
+# start:stop:step thresholds (stop included), e.g. 0.5:0.95:0.05; returns empty list for invalid ones
+def parse_thresholds(thresholds):
+    try:
+        start, stop, step = [float(value) for value in thresholds.split(':')]
+    except ValueError:
+        return []
+    if step <= 0 or stop < start:
+        return []
+    # rounded, so that values are not affected by floating point errors (e.g. 0.6000000000000001)
+    steps = int((stop - start) / step + 1e-9)
+    return [round(start + i * step, 10) for i in range(steps + 1)]
+
+
+# gensim is imported on demand, it is slow to import
+def load_w2v_model(model_path):
+    from gensim.models.word2vec import Word2Vec
+
+    return Word2Vec.load(model_path)
 
 
 def load_freq_list(freq_path):